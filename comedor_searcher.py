@@ -1,11 +1,22 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import gspread
 from google.oauth2.service_account import Credentials
 import pandas as pd
 import json
 from datetime import datetime
 import re
+import html
 import os
+import time
+import random
+import hashlib
+import threading
+import bisect
+import csv
+import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import plotly.express as px
 import plotly.graph_objects as go
 
@@ -52,31 +63,100 @@ SHEET_CONFIG = {
         "search_column": "NOMBRE_COMEDOR",
         "area": "GESTIÓN HUMANA",
         "proposito": "Evaluar el clima organizacional al interior del comedor comunitario, desde la percepción de las gestoras/es para comprender el nivel de relacionamiento, el trabajo en equipo, los liderazgos y el sentido de pertenencia que se vive en el comedor, a partir de la aplicación de una encuesta dirigida a las gestoras/es, de tal manera que nos permita identificar las condiciones que favorecen o dificultan su funcionamiento.",
-        "dashboard": "https://dior25.streamlit.app/"
+        "dashboard": "https://dior25.streamlit.app/",
+        "load": "lazy"  # Encuesta muy ancha: se carga solo el índice; las filas completas se piden al mostrarlas
     },
     "DUB": {
         "name": "📊 DUB",
         "search_column": "Nombre_comedor",
         "area": "CARACTERIZACIÓN",
         "proposito": "Caracterización de grupos poblacionales y poblaciones vulnerables del Distrito de Santiago de Cali, a fin de obtener información detallada y precisa sobre las características demográficas, socioeconómicas, culturales y de salud de estas poblaciones.",
-        "dashboard": "https://dupstory.streamlit.app/"
+        "dashboard": "https://dupstory.streamlit.app/",
+        "load": "lazy"  # Encuesta muy ancha: se carga solo el índice; las filas completas se piden al mostrarlas
     },
     "ENCUESTA": {
         "name": "📝 Encuesta",
         "search_column": "nombre_comedor",
         "area": "NUTRICIÓN",
         "proposito": "Mantener los estándares de calidad diseñados por el proyecto para la entrega de los insumos y/o productos alimentarios, ajustando de manera permanente su accionar al cumplimiento del objetivo dirigido a propiciar el acceso a los alimentos de la población en situación de pobreza monetaria extrema.",
-        "dashboard": "https://satisfaccionutri-qoke9iuewruoyyvebeueci.streamlit.app/"
+        "dashboard": "https://satisfaccionutri-qoke9iuewruoyyvebeueci.streamlit.app/",
+        "sync": "append"  # Encuesta de solo-anexar: se descargan únicamente las filas nuevas
     },
     "VERCOAL": {
         "name": "🚚 VERCOAL",
         "search_column": "nombre_comedor",
         "area": "LOGÍSTICA",
         "proposito": "Verificación de condiciones en la entrega de insumos alimentarios a los comedores comunitarios.",
-        "dashboard": "https://vercoal.streamlit.app/cumplimiento"
+        "dashboard": "https://vercoal.streamlit.app/cumplimiento",
+        "sync": "append"  # Encuesta de solo-anexar: se descargan únicamente las filas nuevas
     }
 }
 
+# Campos canónicos para el análisis cruzado y los nombres de columna que los representan,
+# en orden de preferencia. Cada pestaña puede fijar columnas con "schema" en SHEET_CONFIG.
+SCHEMA_FIELDS = {
+    "direccion": ["direccion", "direccion_comedor", "direccion del comedor"],
+    "barrio": ["barrio", "barrio_comedor"],
+    "comuna": ["comuna", "comuna_comedor"],
+    "fecha": ["fecha", "fecha_visita", "fecha_registro", "fecha de la visita", "marca temporal", "timestamp"],
+    "telefono": ["telefono", "celular", "telefono_contacto", "numero de contacto"],
+    "gestora": ["gestora", "nombre_gestora", "gestor", "nombre de la gestora"]
+}
+
+# Columna oculta con el nombre del comedor normalizado, calculada una sola vez al cargar cada pestaña
+SEARCH_KEY_COLUMN = "_clave_busqueda"
+INTERNAL_COLUMNS = [SEARCH_KEY_COLUMN]
+
+# Autocompletado del buscador
+AUTOCOMPLETE_LIMIT = 20  # Máximo de comedores que se envían al selector del navegador
+RESULTS_PAGE_SIZE = 10  # Tarjetas de resultados que se dibujan por página
+CARD_SUMMARY_FIELDS = 6  # Campos no vacíos que se destacan en cada tarjeta
+
+# Caché de respuestas del asistente IA (compartida por todas las sesiones del proceso)
+RESPONSE_CACHE_SIZE = 128
+
+# Historial de conversación del asistente (por sesión): solo referencias a filas, nunca tablas completas
+CHAT_HISTORY_SIZE = int(os.environ.get("COMEDORES_CHAT_HISTORY_SIZE", 20))  # Interacciones que se conservan
+CHAT_HISTORY_MAX_BYTES = int(os.environ.get("COMEDORES_CHAT_HISTORY_MAX_BYTES", 256 * 1024))  # Tope de memoria por sesión
+
+# Búsqueda tolerante a errores de escritura
+FUZZY_TOP_K = 5  # Cantidad de comedores similares que se sugieren
+FUZZY_MIN_SCORE = 0.3  # Similitud mínima (coeficiente de Dice sobre trigramas) para sugerir un comedor
+
+# Configuración del almacén de datos
+DATA_TTL_SECONDS = 300  # Antigüedad a partir de la cual se refresca una pestaña (se puede ajustar por pestaña con "refresh_seconds")
+REFRESHER_TICK_SECONDS = 15  # Cada cuánto revisa el refrescador en segundo plano qué pestañas están vencidas
+DATA_RETRY_SECONDS = 30  # Espera mínima entre intentos de carga fallidos sin datos previos
+DATA_RETRY_MAX_SECONDS = 600  # Tope de la espera entre reintentos, que se duplica con cada fallo seguido
+DATA_WAIT_SECONDS = 60  # Máximo que una lectura espera la descarga en curso de otro hilo
+FULL_RELOAD_SECONDS = 3600  # Recarga completa periódica de las pestañas "append" (detecta ediciones antiguas)
+SNAPSHOT_DIR = os.environ.get("COMEDORES_SNAPSHOT_DIR", ".snapshots")
+DATA_SOURCE = os.environ.get("COMEDORES_DATA_SOURCE", "google")  # Fuente por defecto: "google" o "local" (cada pestaña puede fijar "source")
+LOCAL_DATA_PATH = os.environ.get("COMEDORES_LOCAL_DATA", "datos_locales")  # Espejo local: directorio de CSV o archivo .db/.sqlite
+# Presupuesto de peticiones y reintentos de la API de Google Sheets (compartidos por todas las sesiones)
+API_REQUESTS_PER_MINUTE = int(os.environ.get("COMEDORES_API_REQUESTS_PER_MINUTE", 50))  # Por debajo de la cuota de lectura (60/min por usuario)
+API_BURST = 10  # Peticiones que se pueden hacer seguidas antes de tener que esperar fichas
+API_MAX_RETRIES = 4  # Reintentos ante 429/5xx antes de dar la petición por fallida
+API_BACKOFF_BASE_SECONDS = 1  # Espera máxima del primer reintento; se duplica en cada uno (con jitter completo)
+API_BACKOFF_MAX_SECONDS = 32
+API_RETRY_STATUS = {429, 500, 502, 503, 504}
+SQL_MIRROR_ENABLED = os.environ.get("COMEDORES_SQL_MIRROR", "1") != "0"  # Réplica SQLite en memoria para búsquedas y agregaciones
+SQL_MIRROR_BATCH_ROWS = 2000  # Filas por lote al escribir la réplica SQL: entre lotes se atienden las consultas
+ROW_CACHE_MAX_ROWS = 2000  # Filas completas que se guardan por pestaña perezosa ("load": "lazy") antes de vaciar su caché
+
+# Representación compacta en memoria de las pestañas cargadas
+CATEGORY_MAX_RATIO = 0.5  # Columnas de texto con a lo sumo esta proporción de valores distintos pasan a categóricas
+NUMERIC_PATTERN = re.compile(r"-?(?:0|[1-9]\d{0,14})(?:\.\d+)?")  # Sin ceros a la izquierda: cédulas y códigos siguen como texto
+THOUSANDS_PATTERN = re.compile(r"-?[1-9]\d{0,2}(?:\.\d{3}){1,4}")  # Enteros con punto de miles, como se escriben en Colombia: 1.500
+DATE_PATTERN = re.compile(r"\d{1,4}[/-]\d{1,2}[/-]\d{1,4}(?: \d{1,2}:\d{2}(?::\d{2})?)?")
+# Formatos de fecha aceptados: ISO (año al inicio) o día/mes/año, el formato local de las hojas.
+# Una columna con algún valor fuera de estos formatos (p. ej. mes/día/año) se deja como texto.
+DATE_FORMATS = [
+    f"{date}{time_part}"
+    for date in ("%Y-%m-%d", "%Y/%m/%d", "%d/%m/%Y", "%d-%m-%Y", "%d/%m/%y")
+    for time_part in ("", " %H:%M:%S", " %H:%M")
+]
+
 # Función para cargar credenciales de Google Sheets
 @st.cache_resource
 def load_google_credentials():
@@ -116,92 +196,1305 @@ def load_google_credentials():
 
 @st.cache_resource
 def connect_to_google_sheets():
-    """Conecta a Google Sheets y retorna el workbook"""
+    """Conecta a Google Sheets y retorna el workbook.
+    
+    Los errores se propagan en lugar de retornar None: st.cache_resource no guarda las
+    excepciones, así que un fallo pasajero no deja el proceso sin conexión y el próximo
+    refresco vuelve a intentarlo.
+    """
+    # Cargar credenciales desde archivo JSON o secrets
+    credentials = load_google_credentials()
+    if credentials is None:
+        raise ConnectionError("No hay credenciales de Google para conectar con Google Sheets")
+    
+    # Autorizar cliente con gspread
+    client = gspread.authorize(credentials)
+    sheet_id = get_google_sheet_id()
     try:
-        # Cargar credenciales desde archivo JSON o secrets
-        credentials = load_google_credentials()
-        if credentials is None:
-            return None
-            
-        # Autorizar cliente con gspread
-        client = gspread.authorize(credentials)
-        sheet_id = get_google_sheet_id()
-        workbook = client.open_by_key(sheet_id)
-        return workbook
-        
+        return client.open_by_key(sheet_id)
     except gspread.exceptions.SpreadsheetNotFound:
-        st.error("❌ No se pudo encontrar el Google Sheet. Verifica el ID del documento.")
-        return None
-    except gspread.exceptions.APIError as e:
-        st.error(f"❌ Error de API de Google Sheets: {str(e)}")
+        raise ConnectionError("No se pudo encontrar el Google Sheet. Verifica el ID del documento.")
+
+def repair_headers(headers):
+    """Encabezados únicos y no vacíos, siempre iguales para la misma fila de encabezados.
+    
+    Los vacíos pasan a "columna_<n>" (n = posición, base 1) y los repetidos reciben
+    un sufijo "_2", "_3"... que no choque con ningún otro encabezado de la fila.
+    """
+    names = [str(header).strip() or f"columna_{i + 1}" for i, header in enumerate(headers)]
+    taken = set(names)
+    seen = set()
+    repaired = []
+    for name in names:
+        if name in seen:
+            suffix = 2
+            while f"{name}_{suffix}" in taken:
+                suffix += 1
+            name = f"{name}_{suffix}"
+            taken.add(name)
+        seen.add(name)
+        repaired.append(name)
+    return repaired
+
+def values_to_dataframe(all_values):
+    """Construye un DataFrame a partir de la matriz de valores de una pestaña (fila 1 = encabezados).
+    
+    La tabla se arma de una vez desde la matriz, con filas recortadas o completadas al
+    ancho de los encabezados. Las filas vacías se conservan para que la posición de cada
+    registro siga correspondiendo a su fila en la hoja; los tipos se ajustan después, al
+    compactar la pestaña.
+    """
+    if len(all_values) < 2:
         return None
-    except Exception as e:
-        st.error(f"❌ Error conectando a Google Sheets: {str(e)}")
-        st.info("💡 Intenta refrescar la página o verifica las credenciales")
+    
+    headers = repair_headers(all_values[0])
+    width = len(headers)
+    rows = [row[:width] if len(row) >= width else list(row) + [''] * (width - len(row)) for row in all_values[1:]]
+    return pd.DataFrame(rows, columns=headers)
+
+def fetch_sheets_values(workbook, sheet_names):
+    """Obtiene los valores de varias pestañas en una sola llamada values:batchGet"""
+    ranges = [f"'{sheet_name}'" for sheet_name in sheet_names]
+    response = workbook.values_batch_get(ranges)
+    value_ranges = response.get("valueRanges", [])
+    return {
+        sheet_name: value_range.get("values", [])
+        for sheet_name, value_range in zip(sheet_names, value_ranges)
+    }
+
+def fetch_worksheet_values(workbook, sheet_name):
+    """Valores de una sola pestaña (dos peticiones: metadatos de la hoja y valores)"""
+    return workbook.worksheet(sheet_name).get_all_values()
+
+def fetch_sheets_values_individually(workbook, sheet_names, call=None):
+    """Obtiene los valores pestaña por pestaña; retorna (valores, errores) por pestaña.
+    
+    call, si se indica, ejecuta cada petición (con presupuesto y reintentos). Los errores
+    de cuota o del servidor no se asignan a la pestaña: se propagan para no seguir
+    insistiendo con las demás.
+    """
+    values_by_sheet = {}
+    errors = {}
+    for sheet_name in sheet_names:
+        try:
+            if call is None:
+                values_by_sheet[sheet_name] = fetch_worksheet_values(workbook, sheet_name)
+            else:
+                values_by_sheet[sheet_name] = call(fetch_worksheet_values, workbook, sheet_name, cost=2)
+        except gspread.exceptions.WorksheetNotFound:
+            errors[sheet_name] = f"No se encontró la pestaña '{sheet_name}' en el Google Sheet"
+        except gspread.exceptions.APIError as e:
+            if api_error_status(e) in API_RETRY_STATUS:
+                raise
+            errors[sheet_name] = str(e)
+        except Exception as e:
+            errors[sheet_name] = str(e)
+    return values_by_sheet, errors
+
+def api_error_status(error):
+    """Código HTTP de un APIError de gspread, tomado de la respuesta.
+    
+    El atributo code sale del cuerpo JSON del error y vale -1 cuando el cuerpo no es JSON
+    (lo habitual en las páginas 502/503 de Google): solo se usa si no hay respuesta.
+    """
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is None:
+        status = getattr(error, "code", None)
+    return status
+
+def column_letter(position):
+    """Letra de columna A1 para una posición (base 1)"""
+    return re.sub(r"\d", "", gspread.utils.rowcol_to_a1(1, position))
+
+def index_columns(headers, config):
+    """Columnas del índice liviano de una pestaña perezosa: nombre del comedor y campos canónicos"""
+    candidates = [config["search_column"]] + list(build_schema_map(headers, config).values())
+    return [column for i, column in enumerate(candidates) if column in headers and column not in candidates[:i]]
+
+def search_column_position(headers, config):
+    """Posición (base 0) de la columna de búsqueda entre los encabezados de la hoja, o None"""
+    repaired = repair_headers(headers)
+    return repaired.index(config["search_column"]) if config["search_column"] in repaired else None
+
+def project_index_values(all_values, config):
+    """Reduce una matriz completa de valores a las columnas del índice (encabezados incluidos)"""
+    if not all_values:
+        return []
+    headers = repair_headers(all_values[0])
+    positions = [headers.index(column) for column in index_columns(headers, config)]
+    return [[headers[i] for i in positions]] + [[row[i] if i < len(row) else '' for i in positions] for row in all_values[1:]]
+
+def fetch_sheets_index_values(workbook, config_by_sheet):
+    """Descarga el índice liviano de varias pestañas perezosas: dos llamadas batch en total.
+    
+    La primera trae los encabezados; la segunda, solo las columnas del índice (completas,
+    por columnas). Retorna (encabezados, valores proyectados) por pestaña.
+    """
+    sheet_names = list(config_by_sheet)
+    response = workbook.values_batch_get([f"'{sheet_name}'!1:1" for sheet_name in sheet_names])
+    headers_by_sheet = {}
+    for sheet_name, value_range in zip(sheet_names, response.get("valueRanges", [])):
+        rows = value_range.get("values", [])
+        headers_by_sheet[sheet_name] = repair_headers(rows[0]) if rows else []
+    
+    columns_by_sheet = {
+        sheet_name: index_columns(headers, config_by_sheet[sheet_name])
+        for sheet_name, headers in headers_by_sheet.items()
+    }
+    ranges = [
+        f"'{sheet_name}'!{column_letter(headers_by_sheet[sheet_name].index(column) + 1)}:"
+        f"{column_letter(headers_by_sheet[sheet_name].index(column) + 1)}"
+        for sheet_name, columns in columns_by_sheet.items()
+        for column in columns
+    ]
+    value_ranges = iter(
+        workbook.values_batch_get(ranges, params={"majorDimension": "COLUMNS"}).get("valueRanges", []) if ranges else []
+    )
+    
+    values_by_sheet = {}
+    for sheet_name, columns in columns_by_sheet.items():
+        column_values = []
+        for column in columns:
+            value_range = next(value_ranges, {})
+            values = value_range.get("values", [])
+            # La primera celda es el encabezado original; se usa el reparado
+            column_values.append([column] + values[0][1:] if values else [column])
+        # La API omite las celdas vacías al final de cada columna: se completan hasta la más larga
+        height = max((len(values) for values in column_values), default=0)
+        column_values = [values + [''] * (height - len(values)) for values in column_values]
+        values_by_sheet[sheet_name] = [list(row) for row in zip(*column_values)]
+    return headers_by_sheet, values_by_sheet
+
+def fetch_sheet_rows(workbook, sheet_name, width, positions):
+    """Descarga filas completas por posición (0 = primera fila de datos), agrupadas en rangos contiguos"""
+    positions = sorted(set(positions))
+    blocks = []
+    for position in positions:
+        if blocks and position == blocks[-1][1] + 1:
+            blocks[-1][1] = position
+        else:
+            blocks.append([position, position])
+    
+    last_column = column_letter(max(width, 1))
+    # La fila 1 de la hoja son los encabezados: la posición p está en la fila p + 2
+    ranges = [f"'{sheet_name}'!A{start + 2}:{last_column}{end + 2}" for start, end in blocks]
+    value_ranges = workbook.values_batch_get(ranges).get("valueRanges", [])
+    
+    rows = {}
+    for (start, end), value_range in zip(blocks, value_ranges):
+        values = value_range.get("values", [])
+        for offset in range(end - start + 1):
+            rows[start + offset] = values[offset] if offset < len(values) else []
+    return rows
+
+def index_values_from_full(values_by_sheet, config_by_sheet):
+    """(encabezados, valores del índice) por pestaña a partir de sus matrices completas"""
+    headers_by_sheet = {
+        sheet_name: repair_headers(all_values[0]) if all_values else []
+        for sheet_name, all_values in values_by_sheet.items()
+    }
+    index_by_sheet = {
+        sheet_name: project_index_values(all_values, config_by_sheet[sheet_name])
+        for sheet_name, all_values in values_by_sheet.items()
+    }
+    return headers_by_sheet, index_by_sheet
+
+def fetch_spreadsheet_revision(workbook):
+    """Consulta a Drive la revisión actual del spreadsheet (petición de metadatos muy pequeña)"""
+    # gspread 6 expone el cliente HTTP en client.http_client; gspread 5 en el propio client
+    http_client = getattr(workbook.client, "http_client", workbook.client)
+    response = http_client.request(
+        "get",
+        f"{gspread.urls.DRIVE_FILES_API_V3_URL}/{workbook.id}",
+        params={"fields": "version,modifiedTime", "supportsAllDrives": True}
+    )
+    metadata = response.json()
+    return metadata.get("version") or metadata.get("modifiedTime")
+
+def row_hash(row, width=None):
+    """Hash de una fila ignorando celdas vacías al final (como las omite la API)"""
+    row = list(row[:width] if width else row)
+    while row and row[-1] == '':
+        row.pop()
+    return values_version(row)
+
+def key_column_hash(rows, position):
+    """Hash de una columna de las filas dadas, ignorando celdas vacías al final (como las omite la API)"""
+    if position is None:
         return None
+    return row_hash([row[position] if position < len(row) else '' for row in rows])
 
-@st.cache_data(ttl=300)
-def load_sheet_data(sheet_name):
-    """Carga los datos de una pestaña específica"""
-    try:
-        workbook = connect_to_google_sheets()
-        if workbook is None:
-            return None
+def values_version(all_values):
+    """Calcula la versión (hash de contenido) de la matriz de valores de una pestaña"""
+    payload = json.dumps(all_values, ensure_ascii=False, default=str).encode("utf-8")
+    return hashlib.sha1(payload).hexdigest()[:12]
+
+# ==========================================
+# FUENTES DE DATOS
+# ==========================================
+
+class RequestBudget:
+    """Cubeta de fichas para las peticiones a la API: per_minute fichas por minuto, hasta burst acumuladas.
+    
+    Cada petición consume una ficha; sin fichas disponibles se espera a que se repongan,
+    así el proceso completo se mantiene bajo la cuota aunque muchas sesiones pidan a la vez.
+    """
+    
+    def __init__(self, per_minute=API_REQUESTS_PER_MINUTE, burst=API_BURST):
+        self.rate = per_minute / 60
+        self.capacity = burst
+        self.requests = 0
+        self.waited_seconds = 0.0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self, cost=1):
+        """Consume cost fichas, esperando lo necesario"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= cost:
+                    self._tokens -= cost
+                    self.requests += cost
+                    return
+                wait = (cost - self._tokens) / self.rate
+                self.waited_seconds += wait
+            time.sleep(wait)
+
+@st.cache_resource
+def get_request_budget():
+    """Presupuesto de peticiones compartido por todas las sesiones del proceso"""
+    return RequestBudget()
+
+class GoogleSheetsSource:
+    """Fuente de datos: el Google Sheet del proyecto, leído con gspread.
+    
+    Todas las fuentes exponen las mismas operaciones que usa el almacén: revision,
+    fetch_values, fetch_index_values, fetch_tails y fetch_rows. Cada petición pasa por
+    el presupuesto compartido y se reintenta ante 429/5xx con espera exponencial.
+    """
+    
+    def __init__(self, budget=None):
+        self.budget = budget or RequestBudget()
+        self._connection = None
+    
+    def _workbook(self):
+        """Workbook conectado; la conexión (open_by_key) pasa por el presupuesto y los reintentos"""
+        if self._connection is None:
+            self._connection = self._call(connect_to_google_sheets)
+        return self._connection
+    
+    def _call(self, function, *args, cost=1):
+        """Ejecuta una lectura con presupuesto; ante 429/5xx reintenta con espera exponencial y jitter completo"""
+        for attempt in range(API_MAX_RETRIES + 1):
+            self.budget.acquire(cost)
+            try:
+                return function(*args)
+            except gspread.exceptions.APIError as e:
+                if api_error_status(e) not in API_RETRY_STATUS or attempt == API_MAX_RETRIES:
+                    raise
+                time.sleep(random.uniform(0, min(API_BACKOFF_MAX_SECONDS, API_BACKOFF_BASE_SECONDS * 2 ** attempt)))
+    
+    def revision(self):
+        """Revisión actual del spreadsheet en Drive"""
+        return self._call(fetch_spreadsheet_revision, self._workbook())
+    
+    def fetch_values(self, sheet_names):
+        """(valores, errores) por pestaña"""
+        workbook = self._workbook()
+        try:
+            return self._call(fetch_sheets_values, workbook, sheet_names), {}
+        except gspread.exceptions.APIError as e:
+            if api_error_status(e) in API_RETRY_STATUS:
+                raise
+            # Si alguna pestaña no existe la petición batch falla completa
+            return fetch_sheets_values_individually(workbook, sheet_names, self._call)
+    
+    def fetch_index_values(self, config_by_sheet):
+        """(encabezados, valores del índice, errores) por pestaña perezosa"""
+        workbook = self._workbook()
+        try:
+            headers_by_sheet, index_by_sheet = self._call(fetch_sheets_index_values, workbook, config_by_sheet, cost=2)
+            return headers_by_sheet, index_by_sheet, {}
+        except gspread.exceptions.APIError as e:
+            if api_error_status(e) in API_RETRY_STATUS:
+                raise
+            values_by_sheet, errors = fetch_sheets_values_individually(workbook, list(config_by_sheet), self._call)
+            return index_values_from_full(values_by_sheet, config_by_sheet) + (errors,)
+    
+    def fetch_tails(self, tails):
+        """Encabezados, filas desde una fila dada y columna de búsqueda completa, en una sola petición.
         
-        # Verificar si la hoja existe
+        {pestaña: (ancho, fila, posición de la columna de búsqueda)} ->
+        {pestaña: (encabezados, filas, valores de la columna de búsqueda)}. Retorna None si
+        la petición es rechazada (las pestañas se recargan completas); los errores de cuota
+        o del servidor se propagan.
+        """
+        ranges = []
+        for sheet_name, (width, start_row, key_position) in tails.items():
+            key_column = column_letter(key_position + 1)
+            ranges.append(f"'{sheet_name}'!1:1")
+            ranges.append(f"'{sheet_name}'!A{start_row}:{column_letter(width)}")
+            ranges.append(f"'{sheet_name}'!{key_column}2:{key_column}")
         try:
-            worksheet = workbook.worksheet(sheet_name)
-        except gspread.exceptions.WorksheetNotFound:
-            st.error(f"❌ No se encontró la pestaña '{sheet_name}' en el Google Sheet")
+            value_ranges = self._call(self._workbook().values_batch_get, ranges).get("valueRanges", [])
+        except gspread.exceptions.APIError as e:
+            if api_error_status(e) in API_RETRY_STATUS:
+                raise
             return None
+        
+        def range_values(position):
+            return value_ranges[position].get("values", []) if position < len(value_ranges) else []
+        
+        result = {}
+        for i, sheet_name in enumerate(tails):
+            header_rows = range_values(3 * i)
+            key_values = [row[0] if row else '' for row in range_values(3 * i + 2)]
+            result[sheet_name] = (header_rows[0] if header_rows else [], range_values(3 * i + 1), key_values)
+        return result
+    
+    def fetch_rows(self, sheet_name, width, positions):
+        """Filas completas por posición (0 = primera fila de datos)"""
+        return self._call(fetch_sheet_rows, self._workbook(), sheet_name, width, positions)
+
+class LocalFileSource:
+    """Fuente de datos: espejo local de las pestañas, sin llamadas de red.
+    
+    path puede ser un directorio con un archivo CSV por pestaña (<PESTAÑA>.csv, fila 1 =
+    encabezados) o un archivo SQLite (.db/.sqlite) con una tabla por pestaña; ninguno de
+    los dos necesita dependencias fuera de requirements.txt. Sirve como espejo rápido en producción (ver sync_local_mirror)
+    y para trabajar sin conexión en desarrollo y pruebas.
+    """
+    
+    SQLITE_EXTENSIONS = (".db", ".sqlite", ".sqlite3")
+    
+    def __init__(self, path):
+        self.path = path
+    
+    def is_sqlite(self):
+        return os.path.splitext(self.path)[1].lower() in self.SQLITE_EXTENSIONS
+    
+    def _sheet_file(self, sheet_name):
+        path = os.path.join(self.path, f"{sheet_name}.csv")
+        return path if os.path.exists(path) else None
+    
+    def read_values(self, sheet_name):
+        """Matriz de valores de la pestaña como texto (fila 1 = encabezados), igual que la API"""
+        if self.is_sqlite():
+            if not os.path.exists(self.path):
+                raise FileNotFoundError(f"No se encontró el espejo local '{self.path}'")
+            with sqlite3.connect(self.path) as connection:
+                try:
+                    cursor = connection.execute(f'SELECT * FROM "{sheet_name}"')
+                except sqlite3.OperationalError:
+                    raise FileNotFoundError(f"No se encontró la pestaña '{sheet_name}' en el espejo local")
+                headers = [column[0] for column in cursor.description]
+                rows = cursor.fetchall()
+            return [headers] + [['' if value is None else str(value) for value in row] for row in rows]
+        
+        path = self._sheet_file(sheet_name)
+        if path is None:
+            raise FileNotFoundError(f"No se encontró la pestaña '{sheet_name}' en el espejo local")
+        with open(path, newline="", encoding="utf-8") as file:
+            return [row for row in csv.reader(file)]
+    
+    def revision(self):
+        """Fecha de modificación y tamaño de los archivos del espejo: cambia con cada sincronización"""
+        if self.is_sqlite():
+            paths = [self.path]
+        elif os.path.isdir(self.path):
+            paths = sorted(os.path.join(self.path, name) for name in os.listdir(self.path))
+        else:
+            return None
+        stats = [[path, os.stat(path).st_mtime_ns, os.stat(path).st_size] for path in paths if os.path.exists(path)]
+        return values_version(stats)
+    
+    def fetch_values(self, sheet_names):
+        values_by_sheet = {}
+        errors = {}
+        for sheet_name in sheet_names:
+            try:
+                values_by_sheet[sheet_name] = self.read_values(sheet_name)
+            except Exception as e:
+                errors[sheet_name] = str(e)
+        return values_by_sheet, errors
+    
+    def fetch_index_values(self, config_by_sheet):
+        # Leer el archivo completo es barato: el índice se proyecta en memoria
+        values_by_sheet, errors = self.fetch_values(list(config_by_sheet))
+        return index_values_from_full(values_by_sheet, config_by_sheet) + (errors,)
+    
+    def fetch_tails(self, tails):
+        values_by_sheet, errors = self.fetch_values(list(tails))
+        if errors:
+            return None
+        # La fila n de la hoja es values[n - 1]
+        result = {}
+        for sheet_name, values in values_by_sheet.items():
+            _, start_row, key_position = tails[sheet_name]
+            key_values = [row[key_position] if key_position < len(row) else '' for row in values[1:]]
+            result[sheet_name] = (values[0] if values else [], values[start_row - 1:], key_values)
+        return result
+    
+    def fetch_rows(self, sheet_name, width, positions):
+        values = self.read_values(sheet_name)
+        return {position: values[position + 1] if position + 1 < len(values) else [] for position in positions}
+    
+    def write_values(self, values_by_sheet):
+        """Reemplaza en el espejo las pestañas indicadas (cada archivo se escribe completo y luego se renombra)"""
+        if self.is_sqlite():
+            with sqlite3.connect(self.path) as connection:
+                for sheet_name, all_values in values_by_sheet.items():
+                    df = values_to_dataframe(all_values)
+                    if df is None:
+                        df = pd.DataFrame(columns=repair_headers(all_values[0] if all_values else []))
+                    df.to_sql(sheet_name, connection, if_exists="replace", index=False)
+            return
+        
+        os.makedirs(self.path, exist_ok=True)
+        for sheet_name, all_values in values_by_sheet.items():
+            path = os.path.join(self.path, f"{sheet_name}.csv")
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", newline="", encoding="utf-8") as file:
+                csv.writer(file).writerows(all_values)
+            os.replace(tmp_path, path)
+
+def make_data_source(kind):
+    """Crea la fuente de datos indicada por SHEET_CONFIG ("source") o por COMEDORES_DATA_SOURCE"""
+    if kind == "google":
+        return GoogleSheetsSource(get_request_budget())
+    if kind == "local":
+        return LocalFileSource(LOCAL_DATA_PATH)
+    raise ValueError(f"Fuente de datos desconocida: '{kind}' (se esperaba 'google' o 'local')")
+
+def sync_local_mirror(path=LOCAL_DATA_PATH, sheet_names=None):
+    """Copia las pestañas del Google Sheet al espejo local; retorna los errores por pestaña.
+    
+    Pensada para ejecutarse periódicamente fuera de la aplicación, por ejemplo:
+    python -c "import comedor_searcher as cs; cs.sync_local_mirror()"
+    """
+    values_by_sheet, errors = GoogleSheetsSource(get_request_budget()).fetch_values(list(sheet_names or SHEET_CONFIG.keys()))
+    LocalFileSource(path).write_values(values_by_sheet)
+    return errors
+
+# ==========================================
+# ALMACÉN DE DATOS CON SNAPSHOTS EN DISCO
+# ==========================================
+
+class SheetStore:
+    """Mantiene la última versión de cada pestaña en memoria y en disco.
+    
+    Las lecturas nunca esperan a Google Sheets si ya existe una versión previa
+    (en memoria o en un snapshot): se sirve esa versión y, si está vencida,
+    se refresca en segundo plano (stale-while-revalidate).
+    """
+    
+    def __init__(self, sheet_config, snapshot_dir, sources=None):
+        self.sheet_config = sheet_config
+        self.snapshot_dir = snapshot_dir
+        self.sources = dict(sources or {})  # tipo de fuente -> fuente; se crean al primer uso
+        self._entries = {}
+        self._errors = {}
+        self._failures = {}  # pestaña -> fallos seguidos al refrescarla
+        self._retry_at = {}  # pestaña -> momento a partir del cual se puede reintentar
+        self._row_cache = {}  # pestaña perezosa -> {"key": (versión, revisión), "rows": {posición: fila completa}}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._refreshed = threading.Condition(self._lock)
+        self._refresher = None
+        self._stop_refresher = threading.Event()
+        self.index = ComedorIndex()
+        self.sql = ComedorSQLMirror() if SQL_MIRROR_ENABLED else None
+        # Identidades, catálogo y las tablas de las que salieron: se publican juntos (ver _publish)
+        self.identities = None
+        self._catalog = None
+        self._published_frames = {}
+        self._index_changes = 0  # cambios del índice, para saber si hace falta publicar
+        self._published_changes = None
+        self._publish_lock = threading.Lock()
+        self._load_snapshots()
+    
+    def get(self, sheet_name):
+        """Retorna el DataFrame de la pestaña, refrescándolo en segundo plano si está vencido"""
+        entry = self._entries.get(sheet_name)
+        
+        if entry is None:
+            # Arranque en frío sin snapshot: no queda más que esperar la descarga. Las pestañas
+            # que otro hilo ya está descargando no se piden de nuevo: se espera su resultado.
+            if self._can_retry(sheet_name):
+                missing = self._claim([name for name in self.sheet_config if name not in self._entries])
+                if missing:
+                    self._refresh_claimed(missing)
+            self._wait_for([sheet_name])
+            entry = self._entries.get(sheet_name)
+        elif self.is_stale(sheet_name, entry):
+            # Normalmente el refrescador ya se encarga; esto cubre el caso en que esté atrasado.
+            # Las pestañas que esperan para reintentar no están vencidas: no se pide nada.
+            due = self.due_sheets()
+            if due:
+                self.refresh_in_background(due)
+        
+        return entry["df"] if entry is not None else None
+    
+    def get_entry(self, sheet_name):
+        """Retorna la entrada completa (df, versión, fecha de carga) sin disparar refrescos"""
+        return self._entries.get(sheet_name)
+    
+    def search(self, search_term, sheet_names=None):
+        """Filas cuyo nombre de comedor contiene el término, por pestaña, resueltas con la tabla FTS5 o el índice invertido"""
+        term = normalize_text(search_term)
+        with self._lock:
+            # El tokenizador trigram de FTS5 necesita al menos tres caracteres
+            if self.sql is not None and self.sql.full_text and len(term) >= 3:
+                positions = self.sql.search(term, sheet_names)
+            else:
+                positions = self.index.search(search_term, sheet_names)
+            frames = {sheet_name: self._entries[sheet_name]["df"] for sheet_name in positions}
+        return {sheet_name: frames[sheet_name].iloc[rows] for sheet_name, rows in positions.items()}
+    
+    def fuzzy_search(self, search_term, limit=FUZZY_TOP_K):
+        """Comedores más parecidos al término, con su puntaje de similitud y cantidad de registros"""
+        candidates = {}
+        with self._lock:
+            # Las variantes de un mismo comedor canónico se agrupan: cuenta la de mejor puntaje
+            # y se reportan el nombre canónico y el total de registros de todas ellas
+            for key, score in self.index.similar_keys(search_term, limit=None):
+                comedor_id = self.identities.resolve(key) if self.identities else None
+                comedor = self.identities.get(comedor_id) if comedor_id else None
+                group = comedor_id or key
+                if group in candidates:
+                    continue
+                if comedor is not None:
+                    name, rows_by_sheet = comedor["nombre"], comedor["filas"]
+                else:
+                    name, rows_by_sheet = self.index.display_name(key), self.index.rows_by_sheet(key)
+                candidates[group] = {
+                    "nombre": name,
+                    "clave": key,
+                    "puntaje": score,
+                    "registros": sum(len(rows) for rows in rows_by_sheet.values())
+                }
+                if len(candidates) == limit:
+                    break
+        return list(candidates.values())
+    
+    def data_version(self):
+        """Versión combinada de todas las pestañas: cambia cuando cambia cualquiera de ellas"""
+        versions = []
+        for sheet_name in self.sheet_config:
+            entry = self._entries.get(sheet_name)
+            versions.append(f"{sheet_name}:{entry['version'] if entry else '-'}")
+        return values_version(versions)
+    
+    def catalog(self):
+        """Catálogo de comedores de la última versión publicada (se reconstruye una vez por lote de cambios)"""
+        if self._catalog is None:
+            self._publish()
+        return self._catalog
+    
+    def _publish(self):
+        """Reconstruye identidades, catálogo y agregados si cambió el índice, fuera del lock del almacén.
+        
+        Se llama una vez por lote de refresco, no por pestaña. Bajo el lock solo se toma una
+        copia del índice y se instala el resultado; mientras se construye, las consultas
+        siguen usando lo publicado antes, junto con las tablas de las que salió.
+        """
+        with self._publish_lock:
+            with self._lock:
+                if self._catalog is not None and self._published_changes == self._index_changes:
+                    return
+                changes = self._index_changes
+                index = self.index.snapshot()
+                frames = {sheet_name: entry["df"] for sheet_name, entry in self._entries.items()}
+                sheet_totals = {sheet_name: len(df) for sheet_name, df in frames.items() if df is not None}
+                schema_maps = {sheet_name: entry.get("schema", {}) for sheet_name, entry in self._entries.items()}
+                data_version = self.data_version()
             
-        # Obtener todos los datos
+            identities = ComedorIdentityTable(index)
+            catalog = ComedorCatalog(identities, sheet_totals, data_version, self.sheet_config, schema_maps)
+            
+            with self._lock:
+                self.identities = identities
+                self._catalog = catalog
+                self._published_frames = frames
+                self._published_changes = changes
+    
+    def ensure_loaded(self):
+        """Garantiza que todas las pestañas tengan datos (carga en frío si hace falta)"""
+        for sheet_name in self.sheet_config:
+            self.get(sheet_name)
+    
+    def comedor_records(self, name, sheet_names=None):
+        """Comedor canónico y sus filas por pestaña, o (None, {}) si el nombre no se reconoce"""
+        with self._lock:
+            comedor = self.identities.get(self.identities.resolve(name)) if self.identities else None
+            if comedor is None:
+                return None, {}
+            # Las posiciones de la identidad corresponden a las tablas con que se publicó
+            frames = {
+                sheet_name: self._published_frames[sheet_name]
+                for sheet_name in comedor["filas"]
+                if sheet_names is None or sheet_name in sheet_names
+            }
+        return comedor, {sheet_name: df.iloc[comedor["filas"][sheet_name]] for sheet_name, df in frames.items()}
+    
+    def lookup(self, name, sheet_names=None):
+        """Filas de un comedor por pestaña: por identidad canónica si el nombre la tiene, si no por subcadena.
+        
+        La decisión no depende de las pestañas pedidas, así que consultar pestaña por
+        pestaña da el mismo resultado que consultarlas todas juntas.
+        """
+        comedor, records = self.comedor_records(name, sheet_names)
+        if comedor is not None:
+            return {sheet_name: rows for sheet_name, rows in records.items() if len(rows) > 0}
+        return self.search(name, sheet_names)
+    
+    def materialize(self, sheet_name, rows):
+        """Filas con todas sus columnas para un subconjunto de la pestaña.
+        
+        En las pestañas perezosas el índice solo trae algunas columnas: las filas completas
+        se descargan por rangos contiguos la primera vez que se piden y quedan en caché
+        mientras no cambien la versión del índice ni la revisión del spreadsheet (el índice
+        no ve las demás columnas, así que cualquier edición invalida la caché). Sin
+        conexión se retornan las columnas del índice.
+        """
+        entry = self._entries.get(sheet_name)
+        if rows is None or len(rows) == 0 or entry is None or "headers" not in entry:
+            return rows
+        
+        cache_key = (entry["version"], entry.get("revision"))
+        with self._lock:
+            cache = self._row_cache.get(sheet_name)
+            if cache is None or cache["key"] != cache_key or len(cache["rows"]) > ROW_CACHE_MAX_ROWS:
+                cache = self._row_cache[sheet_name] = {"key": cache_key, "rows": {}}
+            missing = [position for position in rows.index if position not in cache["rows"]]
+        
+        if missing:
+            try:
+                fetched = self.source_for(sheet_name).fetch_rows(sheet_name, len(entry["headers"]), missing)
+            except Exception:
+                return rows
+            with self._lock:
+                cache["rows"].update(fetched)
+        
+        full = values_to_dataframe([entry["headers"]] + [cache["rows"][position] for position in rows.index])
+        full.index = rows.index
+        # Mismos tipos que en las pestañas completas (fechas, números), sin quitar columnas
+        return self._compact(sheet_name, full, drop_empty=False)
+    
+    def counts_by(self, field, name=None):
+        """Conteos por valor de un campo canónico (consulta SQL), de todo o de un comedor; None sin réplica SQL"""
+        if self.sql is None:
+            return None
+        return self.sql.counts_by(field, *self._sql_comedor(name))
+    
+    def date_ranges(self, name=None):
+        """Rango de fechas por pestaña (consulta SQL), de todo o de un comedor; None sin réplica SQL"""
+        if self.sql is None:
+            return None
+        return self.sql.date_ranges(*self._sql_comedor(name))
+    
+    def _sql_comedor(self, name):
+        """(ID canónico, nombre normalizado) con que la réplica SQL filtra un comedor"""
+        if not name:
+            return None, None
+        with self._lock:
+            comedor_id = self.identities.resolve(name) if self.identities else None
+        return comedor_id, normalize_text(name)
+    
+    def last_error(self, sheet_name):
+        """Retorna el último error de carga de la pestaña, si lo hubo"""
+        return self._errors.get(sheet_name)
+    
+    def refresh_interval(self, sheet_name):
+        return self.sheet_config[sheet_name].get("refresh_seconds", DATA_TTL_SECONDS)
+    
+    def is_stale(self, sheet_name, entry):
+        return time.time() - entry["loaded_at"] > self.refresh_interval(sheet_name)
+    
+    def due_sheets(self):
+        """Pestañas vencidas según su propio intervalo, o sin datos, que no estén esperando para reintentar"""
+        due = []
+        for sheet_name in self.sheet_config:
+            entry = self._entries.get(sheet_name)
+            if (entry is None or self.is_stale(sheet_name, entry)) and self._can_retry(sheet_name):
+                due.append(sheet_name)
+        return due
+    
+    def _can_retry(self, sheet_name):
+        """Sin fallos recientes, o ya pasó la espera del último fallo"""
+        return time.time() >= self._retry_at.get(sheet_name, 0)
+    
+    def _record_failure(self, sheet_name, error):
+        """Registra el error y aleja el próximo intento: DATA_RETRY_SECONDS duplicado por cada fallo seguido, con jitter.
+        
+        Mientras tanto se siguen sirviendo los últimos datos buenos de la pestaña.
+        """
+        failures = self._failures.get(sheet_name, 0) + 1
+        delay = min(DATA_RETRY_MAX_SECONDS, DATA_RETRY_SECONDS * 2 ** (failures - 1))
+        self._failures[sheet_name] = failures
+        self._retry_at[sheet_name] = time.time() + random.uniform(delay / 2, delay)
+        self._errors[sheet_name] = error
+    
+    def degraded_sheets(self):
+        """Pestañas que se sirven con sus últimos datos buenos porque el último refresco falló"""
+        return [sheet_name for sheet_name in self._errors if self._entries.get(sheet_name) is not None]
+    
+    def start_refresher(self):
+        """Inicia el hilo que refresca cada pestaña según su intervalo"""
+        if self._refresher is not None and self._refresher.is_alive():
+            return
+        self._refresher = threading.Thread(target=self._run_refresher, daemon=True)
+        self._refresher.start()
+    
+    def _run_refresher(self):
+        while not self._stop_refresher.wait(REFRESHER_TICK_SECONDS):
+            try:
+                due = self._claim(self.due_sheets())
+                if due:
+                    self._refresh_claimed(due)
+            except Exception:
+                # El hilo debe sobrevivir a cualquier fallo puntual
+                continue
+    
+    def source_for(self, sheet_name):
+        """Fuente de datos de la pestaña: "source" de SHEET_CONFIG o la fuente por defecto"""
+        kind = self.sheet_config[sheet_name].get("source", DATA_SOURCE)
+        with self._lock:
+            if kind not in self.sources:
+                self.sources[kind] = make_data_source(kind)
+            return self.sources[kind]
+    
+    def refresh(self, sheet_names=None, full=False):
+        """Actualiza las pestañas indicadas (todas por defecto) y espera a que terminen.
+        
+        Solo hay un refresco en curso por pestaña: las que ya está refrescando otro hilo
+        no se vuelven a pedir, se espera su resultado.
+        """
+        sheet_names = list(self.sheet_config if sheet_names is None else sheet_names)
+        claimed = self._claim(sheet_names)
+        if claimed:
+            self._refresh_claimed(claimed, full)
+        self._wait_for(sheet_names)
+    
+    def _wait_for(self, sheet_names):
+        with self._lock:
+            self._refreshed.wait_for(lambda: not self._refreshing.intersection(sheet_names), timeout=DATA_WAIT_SECONDS)
+    
+    def _refresh(self, sheet_names, full=False):
+        """Actualiza las pestañas indicadas, agrupadas por fuente de datos.
+        
+        Primero se consulta la revisión de la fuente (en Google Sheets, la de Drive): si no
+        cambió desde la última carga, no se descarga nada y solo se extiende la vigencia.
+        Las pestañas de solo-anexar (``"sync": "append"``) descargan únicamente las filas
+        nuevas; las demás, o las que cambiaron antes de la última fila conocida, se
+        descargan completas en una sola petición batch.
+        """
+        names_by_source = {}
+        for sheet_name in sheet_names:
+            try:
+                names_by_source.setdefault(self.source_for(sheet_name), []).append(sheet_name)
+            except Exception as e:
+                self._record_failure(sheet_name, str(e))
+        for source, names in names_by_source.items():
+            self._refresh_from(source, names, full)
+    
+    def _refresh_from(self, source, sheet_names, full=False):
         try:
-            data = worksheet.get_all_records(empty_value='', default_blank='')
-        except Exception as e:
-            # Fallback: obtener datos como valores y crear DataFrame manualmente
-            # st.info(f"🔄 Cargando {sheet_name} con método alternativo...")
-            all_values = worksheet.get_all_values()
-            if len(all_values) < 2:
-                st.warning(f"⚠️ La pestaña {sheet_name} parece estar vacía")
-                return None
+            revision = self._fetch_revision(source)
+            if not full and revision is not None:
+                # Pestañas ya cargadas con esta misma revisión: solo se extiende su vigencia
+                unchanged = [name for name in sheet_names if self._has_revision(name, revision)]
+                for sheet_name in unchanged:
+                    self._swap(sheet_name, dict(self._entries[sheet_name], loaded_at=time.time()))
+                sheet_names = [name for name in sheet_names if name not in unchanged]
             
-            headers = all_values[0]
-            data_rows = all_values[1:]
-            data = []
-            for row in data_rows:
-                # Asegurar que la fila tenga el mismo número de columnas que los headers
-                while len(row) < len(headers):
-                    row.append('')
-                row_dict = dict(zip(headers, row))
-                data.append(row_dict)
-        
-        if data:
-            df = pd.DataFrame(data)
-            # Limpiar DataFrame: remover filas completamente vacías
-            df = df.dropna(how='all')
-            return df
+            full_names = [name for name in sheet_names if full or not self._can_sync_appended_rows(name)]
+            delta_names = [name for name in sheet_names if name not in full_names]
+            if delta_names:
+                full_names += self._sync_appended_rows(source, delta_names, revision)
+            if full_names:
+                self._load_full(source, full_names, revision)
+        except Exception as e:
+            # Se conservan los datos anteriores; solo se registra el error y se espacia el reintento
+            for sheet_name in sheet_names:
+                self._record_failure(sheet_name, str(e))
+    
+    def _fetch_revision(self, source):
+        """Revisión actual de la fuente, o None si no se pudo consultar (se descarga igual).
+        
+        Los errores de cuota o del servidor se propagan: cuentan como fallo del refresco,
+        porque una descarga completa en ese momento solo empeoraría la situación.
+        """
+        try:
+            return source.revision()
+        except gspread.exceptions.APIError as e:
+            if api_error_status(e) in API_RETRY_STATUS:
+                raise
+            return None
+        except Exception:
+            return None
+    
+    def _has_revision(self, sheet_name, revision):
+        entry = self._entries.get(sheet_name)
+        return entry is not None and entry.get("revision") == revision
+    
+    def _load_full(self, source, sheet_names, revision=None):
+        """Descarga completa de las pestañas indicadas (en las perezosas, completa solo en las columnas del índice)"""
+        eager_names = [name for name in sheet_names if not self.is_lazy(name)]
+        lazy_names = [name for name in sheet_names if self.is_lazy(name)]
+        values_by_sheet = {}
+        lazy_headers = {}
+        errors = {}
+        
+        if eager_names:
+            values_by_sheet, errors = source.fetch_values(eager_names)
+        
+        if lazy_names:
+            lazy_headers, lazy_values, lazy_errors = source.fetch_index_values(
+                {name: self.sheet_config[name] for name in lazy_names}
+            )
+            errors.update(lazy_errors)
+            values_by_sheet.update(lazy_values)
+        
+        for sheet_name, error in errors.items():
+            self._record_failure(sheet_name, error)
+        for sheet_name, all_values in values_by_sheet.items():
+            now = time.time()
+            headers = all_values[0] if all_values else []
+            key_position = search_column_position(headers, self.sheet_config[sheet_name])
+            df, memory = self._prepare(sheet_name, values_to_dataframe(all_values))
+            entry = {
+                "df": df,
+                "memory": memory,
+                "version": values_version(all_values),
+                "loaded_at": now,
+                "revision": revision,
+                "sync": {
+                    "row_count": len(all_values),
+                    "width": len(headers),
+                    "header_hash": row_hash(headers),
+                    "last_row_hash": row_hash(all_values[-1], len(headers)) if all_values else None,
+                    "key_position": key_position,
+                    "key_hash": key_column_hash(all_values[1:], key_position),
+                    "full_loaded_at": now
+                }
+            }
+            if sheet_name in lazy_headers:
+                entry["headers"] = lazy_headers[sheet_name]
+            self._swap(sheet_name, entry)
+    
+    def is_lazy(self, sheet_name):
+        """Pestaña de carga en dos niveles: índice liviano en memoria, filas completas bajo demanda"""
+        return self.sheet_config[sheet_name].get("load") == "lazy"
+    
+    def _can_sync_appended_rows(self, sheet_name):
+        entry = self._entries.get(sheet_name)
+        # Las pestañas perezosas no usan "sync": su índice es angosto y se recarga completo
+        if self.sheet_config[sheet_name].get("sync") != "append" or self.is_lazy(sheet_name) or entry is None:
+            return False
+        sync = entry.get("sync")
+        # El ancho de la hoja se guarda al cargarla: la tabla en memoria pierde columnas al
+        # compactarse, así que sin ese dato (snapshots anteriores) se recarga completa
+        return (
+            entry["df"] is not None
+            and sync is not None
+            and sync.get("width", 0) > 0
+            and sync.get("key_position") is not None
+            and time.time() - sync["full_loaded_at"] < FULL_RELOAD_SECONDS
+        )
+    
+    def _sync_appended_rows(self, source, sheet_names, revision=None):
+        """Descarga solo las filas nuevas; retorna las pestañas que requieren recarga completa"""
+        tails = {}
+        for sheet_name in sheet_names:
+            sync = self._entries[sheet_name]["sync"]
+            # Encabezados + desde la última fila conocida hasta el final (para verificar que no cambió)
+            # y la columna de búsqueda completa, para detectar ediciones en filas anteriores
+            tails[sheet_name] = (sync["width"], sync["row_count"], sync["key_position"])
+        
+        fetched = source.fetch_tails(tails)
+        if fetched is None:
+            return list(sheet_names)
+        
+        needs_full_reload = []
+        for sheet_name in sheet_names:
+            headers, tail_rows, key_values = fetched.get(sheet_name, ([], [], []))
+            if not self._append_rows(sheet_name, headers, tail_rows, key_values, revision):
+                needs_full_reload.append(sheet_name)
+        return needs_full_reload
+    
+    def _append_rows(self, sheet_name, headers, tail_rows, key_values, revision=None):
+        """Anexa las filas nuevas si encabezados, última fila conocida y columna de búsqueda de las filas anteriores no cambiaron.
+        
+        La columna de búsqueda llega completa (una sola columna, barata): una edición del nombre
+        en cualquier fila anterior fuerza la recarga completa, sin esperar a FULL_RELOAD_SECONDS.
+        """
+        entry = self._entries[sheet_name]
+        sync = entry["sync"]
+        known_rows = sync["row_count"] - 1
+        if (
+            row_hash(headers) != sync["header_hash"]
+            or not tail_rows
+            or row_hash(tail_rows[0], len(headers)) != sync["last_row_hash"]
+            or key_column_hash([[value] for value in key_values[:known_rows]], 0) != sync["key_hash"]
+        ):
+            return False
+        
+        new_rows = tail_rows[1:]
+        if not new_rows:
+            self._swap(sheet_name, dict(entry, loaded_at=time.time(), revision=revision))
+            return True
+        
+        new_df, new_memory = self._prepare(sheet_name, values_to_dataframe([headers] + new_rows))
+        # Si una columna nueva no encaja con el tipo ya interpretado (p. ej. "pendiente" en una
+        # columna de fechas) se recarga completa: así queda igual que con una carga completa
+        if any(
+            value_kind(new_df[column]) != value_kind(entry["df"][column])
+            for column in new_df.columns
+            if column in entry["df"].columns
+        ):
+            return False
+        # Al concatenar, las categóricas con categorías distintas vuelven a texto: se compacta de nuevo
+        df = self._compact(sheet_name, pd.concat([entry["df"], new_df], ignore_index=True))
+        previous_memory = entry.get("memory") or {"antes": dataframe_memory(entry["df"])}
+        self._swap(sheet_name, dict(
+            entry,
+            df=df,
+            memory={"antes": previous_memory["antes"] + new_memory["antes"], "despues": dataframe_memory(df)},
+            version=values_version([entry["version"], values_version(new_rows)]),
+            loaded_at=time.time(),
+            revision=revision,
+            sync=dict(
+                sync,
+                width=len(headers),
+                row_count=sync["row_count"] + len(new_rows),
+                last_row_hash=row_hash(new_rows[-1], len(headers)),
+                key_hash=key_column_hash([[value] for value in key_values[:known_rows + len(new_rows)]], 0)
+            )
+        ))
+        return True
+    
+    def refresh_in_background(self, sheet_names=None):
+        """Lanza un refresco en un hilo aparte, evitando duplicar pestañas que ya se están refrescando.
+        
+        None refresca todas las pestañas; una lista vacía no refresca ninguna.
+        """
+        pending = self._claim(self.sheet_config if sheet_names is None else sheet_names)
+        if not pending:
+            return
+        
+        thread = threading.Thread(target=self._refresh_claimed, args=(pending,), daemon=True)
+        thread.start()
+    
+    def _claim(self, sheet_names):
+        """Marca como en refresco las pestañas que no lo estaban y las retorna"""
+        with self._lock:
+            pending = [name for name in sheet_names if name not in self._refreshing]
+            self._refreshing.update(pending)
+        return pending
+    
+    def _refresh_claimed(self, sheet_names, full=False):
+        """Refresca pestañas ya marcadas con _claim, las libera y despierta a quienes las esperan"""
+        try:
+            self._refresh(sheet_names, full)
+            # Identidades y catálogo se reconstruyen una vez por lote, no por cada pestaña
+            self._publish()
+        finally:
+            with self._lock:
+                self._refreshing.difference_update(sheet_names)
+                self._refreshed.notify_all()
+    
+    def _swap(self, sheet_name, entry):
+        """Reemplaza la entrada de la pestaña (y su parte del índice) de forma atómica y la persiste en disco"""
+        previous = self._entries.get(sheet_name)
+        changed = previous is None or previous["version"] != entry["version"]
+        # Lo costoso se calcula antes de tomar el lock para que el reemplazo sea instantáneo
+        search_column = self.sheet_config[sheet_name]["search_column"]
+        sheet_keys = ComedorIndex.sheet_keys(entry["df"], search_column) if changed else None
+        sql_generation = None
+        if changed:
+            entry = dict(entry, schema=self._schema_map(sheet_name, entry))
+            if self.sql is not None:
+                # La réplica SQL se escribe en una generación nueva, invisible hasta activarla
+                sql_rows = ComedorSQLMirror.sheet_rows(entry["df"], self.sheet_config[sheet_name], entry["schema"])
+                sql_generation = self.sql.stage_sheet(sheet_name, sql_rows)
+        
+        previous_generation = None
+        with self._lock:
+            self._entries[sheet_name] = entry
+            if changed:
+                self.index.replace_sheet(sheet_name, sheet_keys)
+                if sql_generation is not None:
+                    previous_generation = self.sql.activate(sheet_name, sql_generation)
+                self._index_changes += 1
+            self._errors.pop(sheet_name, None)
+            self._failures.pop(sheet_name, None)
+            self._retry_at.pop(sheet_name, None)
+        if previous_generation is not None:
+            self.sql.retire(previous_generation)
+        # Sin cambios de contenido no vale la pena reescribir el snapshot
+        if changed:
+            self._save_snapshot(sheet_name, entry)
+    
+    def _prepare(self, sheet_name, df):
+        """Paso de ingesta: agrega las columnas derivadas que usan las búsquedas y compacta la tabla.
+        
+        Retorna la tabla y la memoria que ocupa antes y después de compactarla.
+        """
+        if df is None:
+            return df, {"antes": 0, "despues": 0}
+        if SEARCH_KEY_COLUMN not in df.columns:
+            df = prepare_sheet_dataframe(df, self.sheet_config[sheet_name])
+        before = dataframe_memory(df)
+        df = self._compact(sheet_name, df)
+        return df, {"antes": before, "despues": dataframe_memory(df)}
+    
+    def _compact(self, sheet_name, df, drop_empty=True):
+        text_columns = [self.sheet_config[sheet_name]["search_column"]] + INTERNAL_COLUMNS
+        return compact_dataframe(df, text_columns=text_columns, drop_empty=drop_empty)
+    
+    def memory_report(self):
+        """Memoria por pestaña antes y después de compactar, para operadores"""
+        return {
+            sheet_name: entry.get("memory") or {"antes": dataframe_memory(entry["df"]), "despues": dataframe_memory(entry["df"])}
+            for sheet_name, entry in self._entries.items()
+        }
+    
+    def _schema_map(self, sheet_name, entry):
+        """Paso de ingesta: campos canónicos → columnas concretas de la pestaña"""
+        # En las pestañas perezosas se mapea sobre los encabezados completos, no solo los del índice
+        if "headers" in entry:
+            return build_schema_map(entry["headers"], self.sheet_config[sheet_name])
+        if entry["df"] is None:
+            return {}
+        return build_schema_map(entry["df"].columns, self.sheet_config[sheet_name])
+    
+    def _snapshot_path(self, sheet_name):
+        return os.path.join(self.snapshot_dir, f"{sheet_name}.pkl")
+    
+    def _save_snapshot(self, sheet_name, entry):
+        try:
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            path = self._snapshot_path(sheet_name)
+            tmp_path = f"{path}.tmp"
+            pd.to_pickle(entry, tmp_path)
+            os.replace(tmp_path, path)
+        except Exception:
+            # El snapshot es solo una optimización: un fallo de disco no debe romper la carga
+            pass
+    
+    def _load_snapshots(self):
+        for sheet_name in self.sheet_config:
+            path = self._snapshot_path(sheet_name)
+            if not os.path.exists(path):
+                continue
+            try:
+                entry = pd.read_pickle(path)
+                df, memory = self._prepare(sheet_name, entry["df"])
+                # Un snapshot ya compacto conserva la medición original de su carga
+                entry = dict(entry, df=df, memory=entry.get("memory") or memory)
+                entry["schema"] = self._schema_map(sheet_name, entry)
+                self._entries[sheet_name] = entry
+                search_column = self.sheet_config[sheet_name]["search_column"]
+                self.index.replace_sheet(sheet_name, ComedorIndex.sheet_keys(entry["df"], search_column))
+                if self.sql is not None:
+                    self.sql.replace_sheet(
+                        sheet_name, ComedorSQLMirror.sheet_rows(entry["df"], self.sheet_config[sheet_name], entry["schema"])
+                    )
+            except Exception:
+                # Snapshot corrupto o de otra versión de pandas: se ignora
+                continue
+        self._publish()
+
+@st.cache_resource
+def get_sheet_store():
+    """Retorna el almacén de datos compartido por todas las sesiones del proceso"""
+    store = SheetStore(SHEET_CONFIG, SNAPSHOT_DIR)
+    store.start_refresher()
+    return store
+
+def load_sheet_data(sheet_name):
+    """Carga los datos de una pestaña específica"""
+    store = get_sheet_store()
+    df = store.get(sheet_name)
+    
+    if df is None:
+        error = store.last_error(sheet_name)
+        if error:
+            st.error(f"❌ Error cargando datos de {sheet_name}: {error}")
         else:
             st.warning(f"⚠️ No se encontraron datos en la pestaña {sheet_name}")
-            return None
-            
-    except Exception as e:
-        st.error(f"❌ Error cargando datos de {sheet_name}: {str(e)}")
         return None
+    
+    return df
+
+# Tabla de traducción de acentos usada tanto por normalize_text como por normalize_series
+ACCENT_TABLE = str.maketrans("áàäâéèëêíìïîóòöôúùüûñ", "aaaaeeeeiiiioooouuuun")
 
 def normalize_text(text):
     """Normaliza el texto para búsqueda"""
     if pd.isna(text) or text == "":
         return ""
-    text = str(text).lower().strip()
-    # Remover acentos y caracteres especiales
-    text = re.sub(r'[áàäâ]', 'a', text)
-    text = re.sub(r'[éèëê]', 'e', text)
-    text = re.sub(r'[íìïî]', 'i', text)
-    text = re.sub(r'[óòöô]', 'o', text)
-    text = re.sub(r'[úùüû]', 'u', text)
-    text = re.sub(r'[ñ]', 'n', text)
-    return text
+    # Minúsculas, sin espacios extremos, sin acentos ni eñes
+    return str(text).lower().strip().translate(ACCENT_TABLE)
+
+def normalize_series(series):
+    """Versión vectorizada de normalize_text para una columna completa"""
+    return series.fillna("").astype(str).str.lower().str.strip().str.translate(ACCENT_TABLE)
+
+def prepare_sheet_dataframe(df, config):
+    """Agrega la clave de búsqueda normalizada de la pestaña (se ejecuta una vez por carga)"""
+    search_column = config["search_column"]
+    df = df.copy()
+    if search_column in df.columns:
+        df[SEARCH_KEY_COLUMN] = normalize_series(df[search_column])
+    else:
+        df[SEARCH_KEY_COLUMN] = ""
+    return df
+
+def compact_column(series, parse_values=True):
+    """Versión compacta de una columna de texto: fecha, número o categórica si alguna aplica"""
+    text = series.astype(object).where(series.notna(), "").astype(str).str.strip()
+    filled = text[text != ""]
+    
+    if parse_values and len(filled) > 0:
+        # Fechas y números se interpretan una sola vez, solo si todos los valores tienen ese formato
+        if filled.str.fullmatch(DATE_PATTERN).all():
+            dates = parse_dates(text)
+            if dates.notna().sum() == len(filled):
+                return dates
+        grouped = filled.str.fullmatch(THOUSANDS_PATTERN)
+        if (filled.str.fullmatch(NUMERIC_PATTERN) | grouped).all():
+            # El punto es de miles si todos los valores con punto admiten esa lectura (1.500 = 1500);
+            # es decimal solo si ninguno la admite. Una columna con ambos casos queda como texto.
+            dotted = filled.str.contains(".", regex=False)
+            if grouped[dotted].all():
+                return pd.to_numeric(text.where(text != "").str.replace(".", "", regex=False)).astype("Int64")
+            if not grouped.any():
+                return pd.to_numeric(text.where(text != ""))
+    
+    if text.nunique() <= max(1, len(text) * CATEGORY_MAX_RATIO):
+        categories = text.astype("category")
+        # En tablas muy chicas el diccionario de categorías puede costar más de lo que ahorra
+        if categories.memory_usage(deep=True) < series.memory_usage(deep=True):
+            return categories
+    return series
+
+def parse_dates(text):
+    """Interpreta cada valor con el primer formato de DATE_FORMATS que le sirva (NaT si ninguno).
+    
+    Los formatos son explícitos para que dos valores de la misma columna nunca se lean
+    en órdenes distintos (día/mes en uno, mes/día en otro).
+    """
+    dates = pd.Series(pd.NaT, index=text.index, dtype="datetime64[ns]")
+    pending = text != ""
+    for date_format in DATE_FORMATS:
+        if not pending.any():
+            break
+        parsed = pd.to_datetime(text[pending], format=date_format, errors="coerce")
+        dates[parsed.index] = dates[parsed.index].fillna(parsed)
+        pending &= dates.isna()
+    return dates
+
+def value_kind(series):
+    """Tipo interpretado de una columna compacta: fecha, número o texto"""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return "fecha"
+    if pd.api.types.is_numeric_dtype(series):
+        return "numero"
+    return "texto"
+
+def compact_dataframe(df, text_columns=(), drop_empty=True):
+    """Compacta una pestaña: quita columnas vacías e interpreta o categoriza las columnas de texto.
+    
+    Las columnas de text_columns (nombre del comedor y claves) nunca se vacían ni se
+    interpretan como fecha o número; como mucho pasan a categóricas. Con drop_empty=False
+    se conservan todas las columnas (filas completas que se muestran tal cual).
+    """
+    if df is None or df.empty:
+        return df
+    
+    columns = {}
+    for column in df.columns:
+        series = df[column]
+        if not (pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)):
+            columns[column] = series
+            continue
+        protected = column in text_columns
+        if drop_empty and not protected and (series.isna() | series.astype(str).str.strip().eq("")).all():
+            continue
+        columns[column] = compact_column(series, parse_values=not protected)
+    return pd.DataFrame(columns, index=df.index)
+
+def dataframe_memory(df):
+    """Bytes que ocupa la tabla en memoria, incluido el contenido de los textos"""
+    if df is None:
+        return 0
+    return int(df.memory_usage(deep=True).sum())
+
+def column_key(column):
+    """Nombre de columna comparable: normalizado y con separadores unificados"""
+    return re.sub(r"[^a-z0-9]+", "_", normalize_text(column)).strip("_")
+
+def build_schema_map(columns, config):
+    """Mapea cada campo canónico de SCHEMA_FIELDS a una columna concreta de la pestaña.
+    
+    Prioridad: columna fijada en config["schema"], luego coincidencia exacta con un sinónimo
+    (en el orden configurado), luego columna que empieza por un sinónimo y, por último,
+    columna que lo contiene. Ante empates gana la primera columna de la pestaña.
+    """
+    columns = [column for column in columns if column not in INTERNAL_COLUMNS]
+    keys = [column_key(column) for column in columns]
+    overrides = config.get("schema", {})
+    schema = {}
+    
+    for field, synonyms in SCHEMA_FIELDS.items():
+        if overrides.get(field) in columns:
+            schema[field] = overrides[field]
+            continue
+        
+        synonym_keys = [column_key(synonym) for synonym in synonyms]
+        for matches in (
+            lambda key, synonym: key == synonym,
+            lambda key, synonym: key.startswith(synonym),
+            lambda key, synonym: synonym in key
+        ):
+            column = next(
+                (columns[i] for synonym in synonym_keys for i, key in enumerate(keys) if matches(key, synonym)),
+                None
+            )
+            if column is not None:
+                schema[field] = column
+                break
+    return schema
+
+def drop_internal_columns(data):
+    """Quita las columnas internas de un DataFrame o registro antes de mostrarlo"""
+    if isinstance(data, pd.Series):
+        return data.drop(labels=INTERNAL_COLUMNS, errors="ignore")
+    return data.drop(columns=INTERNAL_COLUMNS, errors="ignore")
+
+def format_dates(dates):
+    """Fechas como texto día/mes/año, el formato de las hojas; la hora solo si alguna no es medianoche"""
+    present = dates.dropna()
+    has_time = (present != present.dt.normalize()).any()
+    text = dates.dt.strftime("%d/%m/%Y %H:%M:%S" if has_time else "%d/%m/%Y")
+    return text.where(dates.notna(), "")
+
+def format_for_display(df):
+    """Copia de la tabla lista para mostrar: sin columnas internas y con las fechas como en la hoja"""
+    df = drop_internal_columns(df)
+    date_columns = [column for column in df.columns if pd.api.types.is_datetime64_any_dtype(df[column])]
+    if not date_columns:
+        return df
+    df = df.copy()
+    for column in date_columns:
+        df[column] = format_dates(df[column])
+    return df
 
 def search_in_dataframe(df, search_column, search_term):
     """Busca en un DataFrame específico"""
@@ -213,90 +1506,818 @@ def search_in_dataframe(df, search_column, search_term):
     
     search_term_normalized = normalize_text(search_term)
     
-    # Crear una máscara de búsqueda
-    mask = df[search_column].astype(str).apply(normalize_text).str.contains(search_term_normalized, na=False)
+    # La clave normalizada ya viene calculada desde la carga; solo queda la comparación de subcadenas
+    if SEARCH_KEY_COLUMN in df.columns:
+        search_keys = df[SEARCH_KEY_COLUMN]
+    else:
+        search_keys = normalize_series(df[search_column])
+    mask = search_keys.str.contains(search_term_normalized, regex=False, na=False)
     
     return df[mask]
-def display_record_card(record, sheet_name):
-    """Muestra una tarjeta con la información del registro"""
-    config = SHEET_CONFIG[sheet_name]
+# ==========================================
+# RÉPLICA SQL EMBEBIDA (SQLITE EN MEMORIA)
+# ==========================================
+
+class ComedorSQLMirror:
+    """Réplica SQLite en memoria de todas las pestañas, actualizada en cada carga.
+    
+    Cada fila de cada pestaña es un registro de la tabla "registros" con su posición,
+    la clave normalizada de búsqueda, la clave canónica y el ID del comedor (los mismos
+    de ComedorIdentityTable) y los campos canónicos de SCHEMA_FIELDS. Las claves y la
+    comuna están indexadas, y la tabla FTS5 "nombres" (tokenizador trigram) resuelve
+    las búsquedas por subcadena. Si la versión de SQLite no trae FTS5, las búsquedas
+    quedan a cargo del índice invertido y solo se usan las agregaciones.
+    
+    Cada carga de una pestaña se escribe como una generación nueva (stage_sheet), por
+    lotes y sin bloquear las consultas, que solo ven la generación activa de cada
+    pestaña. activate la hace visible al instante y retire borra la anterior.
+    """
     
-    with st.container():
-        st.markdown(f"""
-        <div style="
-            border: 1px solid #ddd; 
-            border-radius: 10px; 
-            padding: 15px; 
-            margin: 10px 0; 
-            background-color: #f9f9f9;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-        ">
-        """, unsafe_allow_html=True)
+    def __init__(self):
+        self._connection = sqlite3.connect(":memory:", check_same_thread=False)
+        self._lock = threading.Lock()
+        self._active = {}  # pestaña -> generación visible en las consultas
+        self._next_generation = 1
+        self._next_rowid = 1
+        self._rowids = {}  # generación -> (primer rowid, último rowid) en registros y nombres
+        fields = ", ".join(f"{field} TEXT" for field in SCHEMA_FIELDS)
+        with self._lock, self._connection:
+            self._connection.execute(f"""
+                CREATE TABLE registros (
+                    hoja TEXT NOT NULL,
+                    generacion INTEGER NOT NULL,
+                    fila INTEGER NOT NULL,
+                    busqueda TEXT NOT NULL,
+                    clave TEXT NOT NULL,
+                    comedor_id TEXT,
+                    nombre TEXT,
+                    {fields}
+                )
+            """)
+            self._connection.execute("CREATE INDEX registros_generacion ON registros (generacion, fila)")
+            self._connection.execute("CREATE INDEX registros_comedor ON registros (comedor_id)")
+            self._connection.execute("CREATE INDEX registros_busqueda ON registros (busqueda)")
+            self._connection.execute("CREATE INDEX registros_comuna ON registros (comuna)")
+            try:
+                self._connection.execute(
+                    "CREATE VIRTUAL TABLE nombres USING fts5("
+                    "busqueda, hoja UNINDEXED, fila UNINDEXED, generacion UNINDEXED, tokenize='trigram')"
+                )
+                self.full_text = True
+            except sqlite3.OperationalError:
+                self.full_text = False
+    
+    @staticmethod
+    def sheet_rows(df, config, schema):
+        """Filas a insertar para una pestaña (se calcula fuera de cualquier lock)"""
+        if df is None or df.empty or SEARCH_KEY_COLUMN not in df.columns:
+            return []
+        keys = df[SEARCH_KEY_COLUMN].astype(str)
+        # Las funciones de clave se aplican una vez por nombre distinto, no por fila
+        canonical = {key: canonical_comedor_key(key) for key in keys.unique()}
+        canonical_keys = keys.map(canonical)
+        comedor_ids = canonical_keys.map(lambda key: canonical_comedor_id(key) if key else None)
+        search_column = config["search_column"]
+        names = df[search_column].astype(str).str.strip() if search_column in df.columns else keys
         
-        col1, col2 = st.columns([3, 1])
+        columns = [range(len(df)), keys, canonical_keys, comedor_ids, names]
+        for field in SCHEMA_FIELDS:
+            column = schema.get(field)
+            if column is None or column not in df.columns:
+                columns.append([None] * len(df))
+            elif field == "fecha":
+                # Fechas en ISO para que MIN/MAX ordenen bien; lo que no se pueda leer queda en NULL
+                dates = df[column] if pd.api.types.is_datetime64_any_dtype(df[column]) else compact_column(df[column])
+                if not pd.api.types.is_datetime64_any_dtype(dates):
+                    columns.append([None] * len(df))
+                else:
+                    columns.append(dates.dt.strftime("%Y-%m-%d %H:%M:%S").where(dates.notna(), None))
+            else:
+                values = df[column].astype(object)
+                columns.append(values.where(values.notna(), "").astype(str).str.strip())
+        return list(zip(*columns))
+    
+    def stage_sheet(self, sheet_name, rows):
+        """Escribe los registros de una pestaña (calculados con sheet_rows) como una generación nueva, aún invisible.
         
-        with col1:
-            st.markdown(f"### {config['name']}")
+        Se escribe por lotes de SQL_MIRROR_BATCH_ROWS y el lock se suelta entre uno y otro,
+        así las consultas no esperan la carga completa. Retorna la generación.
+        """
+        with self._lock:
+            generation = self._next_generation
+            first_rowid = self._next_rowid
+            self._next_generation += 1
+            self._next_rowid += len(rows)
+            self._rowids[generation] = (first_rowid, first_rowid + len(rows) - 1)
         
-        with col2:
-            st.markdown(f"**Tabla:** `{sheet_name}`")
-        
-        # Mostrar información del área y propósito
-        st.markdown(f"**🏢 Área:** {config['area']}")
-        if config['dashboard']:
-            st.markdown(f"**📈 Dashboard:** [{config['dashboard']}]({config['dashboard']})")
-        
-        # Mostrar algunos campos importantes del registro
-        search_col = config['search_column']
-        if search_col in record.index and pd.notna(record[search_col]):
-            st.markdown(f"**🍽️ Comedor:** {record[search_col]}")
-        
-        # Mostrar otros campos relevantes (primeros 6 campos no vacíos)
-        shown_fields = 0
-        cols = st.columns(2)
-        for field, value in record.items():
-            if shown_fields >= 6:
+        # rowid, hoja, generacion, fila, busqueda, clave, comedor_id, nombre y los campos canónicos
+        placeholders = ", ".join(["?"] * (len(SCHEMA_FIELDS) + 8))
+        for start in range(0, len(rows), SQL_MIRROR_BATCH_ROWS):
+            batch = [
+                (first_rowid + start + offset, sheet_name, generation) + tuple(row)
+                for offset, row in enumerate(rows[start:start + SQL_MIRROR_BATCH_ROWS])
+            ]
+            with self._lock, self._connection:
+                self._connection.executemany(
+                    f"INSERT INTO registros (rowid, hoja, generacion, fila, busqueda, clave, comedor_id, nombre, "
+                    f"{', '.join(SCHEMA_FIELDS)}) VALUES ({placeholders})",
+                    batch
+                )
+                if self.full_text:
+                    # Mismo rowid que en registros, para poder borrar la generación por rangos
+                    self._connection.executemany(
+                        "INSERT INTO nombres (rowid, busqueda, hoja, fila, generacion) VALUES (?, ?, ?, ?, ?)",
+                        [(row[0], row[4], sheet_name, row[3], generation) for row in batch if row[4] != '']
+                    )
+        return generation
+    
+    def activate(self, sheet_name, generation):
+        """Hace visible una generación de la pestaña; retorna la que reemplaza (o None)"""
+        with self._lock:
+            previous = self._active.get(sheet_name)
+            self._active[sheet_name] = generation
+        return previous
+    
+    def retire(self, generation):
+        """Borra una generación que ya no está activa, por lotes (rangos de rowid)"""
+        with self._lock:
+            first_rowid, last_rowid = self._rowids.pop(generation, (1, 0))
+        for start in range(first_rowid, last_rowid + 1, SQL_MIRROR_BATCH_ROWS):
+            end = min(start + SQL_MIRROR_BATCH_ROWS - 1, last_rowid)
+            with self._lock, self._connection:
+                self._connection.execute("DELETE FROM registros WHERE rowid BETWEEN ? AND ?", (start, end))
+                if self.full_text:
+                    self._connection.execute("DELETE FROM nombres WHERE rowid BETWEEN ? AND ?", (start, end))
+    
+    def replace_sheet(self, sheet_name, rows):
+        """Reemplaza los registros de una pestaña en un solo paso (escribe, activa y borra la generación anterior)"""
+        previous = self.activate(sheet_name, self.stage_sheet(sheet_name, rows))
+        if previous is not None:
+            self.retire(previous)
+    
+    def _active_filter(self):
+        """Condición que limita una consulta a las generaciones activas (se llama con el lock tomado)"""
+        generations = tuple(self._active.values())
+        return f"generacion IN ({', '.join(['?'] * len(generations))})", generations
+    
+    def search(self, normalized_term, sheet_names=None):
+        """Posiciones de fila por pestaña cuya clave contiene el término (ya normalizado, 3+ caracteres)"""
+        phrase = '"' + normalized_term.replace('"', '""') + '"'
+        with self._lock:
+            active, generations = self._active_filter()
+            rows = self._connection.execute(
+                f"SELECT hoja, fila FROM nombres WHERE nombres MATCH ? AND {active} ORDER BY hoja, fila",
+                (phrase,) + generations
+            ).fetchall()
+        matches = {}
+        for sheet_name, position in rows:
+            if sheet_names is None or sheet_name in sheet_names:
+                matches.setdefault(sheet_name, []).append(int(position))
+        return matches
+    
+    def _comedor_filter(self, comedor_id=None, normalized_name=None):
+        """Condición WHERE para un comedor: por ID canónico o, si no se reconoce, por subcadena de la clave"""
+        if comedor_id:
+            return " AND comedor_id = ?", (comedor_id,)
+        if normalized_name:
+            return " AND instr(busqueda, ?) > 0", (normalized_name,)
+        return "", ()
+    
+    def counts_by(self, field, comedor_id=None, normalized_name=None):
+        """Registros, comedores distintos y pestañas por valor de un campo canónico (p. ej. comuna)"""
+        if field not in SCHEMA_FIELDS:
+            raise ValueError(f"Campo desconocido: {field}")
+        condition, params = self._comedor_filter(comedor_id, normalized_name)
+        with self._lock:
+            active, generations = self._active_filter()
+            return self._connection.execute(
+                f"SELECT {field}, COUNT(*), COUNT(DISTINCT comedor_id), COUNT(DISTINCT hoja) FROM registros "
+                f"WHERE {active} AND {field} IS NOT NULL AND {field} != ''{condition} "
+                f"GROUP BY {field} ORDER BY COUNT(*) DESC, {field}",
+                generations + params
+            ).fetchall()
+    
+    def date_ranges(self, comedor_id=None, normalized_name=None):
+        """Primera y última fecha y registros con fecha, por pestaña"""
+        condition, params = self._comedor_filter(comedor_id, normalized_name)
+        with self._lock:
+            active, generations = self._active_filter()
+            return self._connection.execute(
+                "SELECT hoja, MIN(fecha), MAX(fecha), COUNT(fecha) FROM registros "
+                f"WHERE {active} AND fecha IS NOT NULL{condition} GROUP BY hoja ORDER BY hoja",
+                generations + params
+            ).fetchall()
+
+# ==========================================
+# ÍNDICE INVERTIDO DE NOMBRES DE COMEDORES
+# ==========================================
+
+def trigrams(text):
+    """Conjunto de trigramas (subcadenas de 3 caracteres) de un texto"""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class ComedorIndex:
+    """Índice invertido trigrama → claves normalizadas, sobre todas las pestañas.
+    
+    Cada clave normalizada apunta a las posiciones de fila (iloc) donde aparece en cada
+    pestaña, de modo que una búsqueda "contiene" se resuelve intersectando postings y
+    verificando solo las claves candidatas, sin recorrer los DataFrames.
+    """
+    
+    def __init__(self):
+        self._postings = {}  # trigrama -> set de claves
+        self._rows = {}  # clave -> {pestaña: array de posiciones}
+        self._names = {}  # clave -> {pestaña: escritura más frecuente del nombre}
+    
+    @staticmethod
+    def sheet_keys(df, search_column):
+        """Agrupa por clave normalizada las posiciones de fila y la escritura más frecuente del nombre"""
+        if df is None or df.empty or SEARCH_KEY_COLUMN not in df.columns or search_column not in df.columns:
+            return {}
+        positions = df.groupby(SEARCH_KEY_COLUMN, sort=False, observed=True).indices
+        positions.pop("", None)
+        
+        names = pd.DataFrame({
+            "clave": df[SEARCH_KEY_COLUMN].astype(str),
+            "nombre": df[search_column].astype(str).str.strip()
+        })
+        names = names[names["clave"] != ""].groupby(["clave", "nombre"]).size().reset_index(name="n")
+        names = names.sort_values("n", ascending=False).drop_duplicates("clave")
+        names = dict(zip(names["clave"], names["nombre"]))
+        
+        return {key: (rows, names[key]) for key, rows in positions.items()}
+    
+    def replace_sheet(self, sheet_name, sheet_keys):
+        """Reemplaza solo las entradas de una pestaña (reconstrucción incremental)"""
+        for key in list(self._rows):
+            sheets = self._rows[key]
+            if sheet_name in sheets and key not in sheet_keys:
+                del sheets[sheet_name]
+                del self._names[key][sheet_name]
+                if not sheets:
+                    self._remove_key(key)
+        
+        for key, (rows, name) in sheet_keys.items():
+            if key not in self._rows:
+                self._rows[key] = {}
+                self._names[key] = {}
+                for trigram in trigrams(key):
+                    self._postings.setdefault(trigram, set()).add(key)
+            self._rows[key][sheet_name] = rows
+            self._names[key][sheet_name] = name
+    
+    def keys(self):
+        return self._rows.keys()
+    
+    def snapshot(self):
+        """Copia de claves, filas y nombres (sin postings) para construir identidades fuera del lock"""
+        copy = ComedorIndex()
+        copy._rows = {key: dict(rows_by_sheet) for key, rows_by_sheet in self._rows.items()}
+        copy._names = {key: dict(names) for key, names in self._names.items()}
+        return copy
+    
+    def display_name(self, key):
+        """Escritura del nombre en la pestaña donde la clave tiene más registros"""
+        rows_by_sheet = self._rows[key]
+        sheet_name = max(rows_by_sheet, key=lambda name: len(rows_by_sheet[name]))
+        return self._names[key][sheet_name]
+    
+    def _remove_key(self, key):
+        del self._rows[key]
+        del self._names[key]
+        for trigram in trigrams(key):
+            keys = self._postings.get(trigram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._postings[trigram]
+    
+    def matching_keys(self, search_term):
+        """Claves normalizadas que contienen el término"""
+        term = normalize_text(search_term)
+        if not term:
+            return []
+        
+        if len(term) < 3:
+            # Sin trigramas que intersectar: se recorren las claves distintas (mucho menos que las filas)
+            candidates = self._rows.keys()
+        else:
+            postings = sorted((self._postings.get(trigram, set()) for trigram in trigrams(term)), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+        return [key for key in candidates if term in key]
+    
+    def similar_keys(self, search_term, limit=FUZZY_TOP_K, min_score=FUZZY_MIN_SCORE):
+        """Claves más parecidas al término, como [(clave, puntaje)] ordenadas por puntaje (todas con limit=None)"""
+        term_trigrams = trigrams(normalize_text(search_term))
+        if not term_trigrams:
+            return []
+        
+        # Trigramas compartidos por clave, contados solo sobre los postings del término
+        shared = {}
+        for trigram in term_trigrams:
+            for key in self._postings.get(trigram, ()):
+                shared[key] = shared.get(key, 0) + 1
+        
+        scored = []
+        for key, count in shared.items():
+            score = 2 * count / (len(term_trigrams) + len(trigrams(key)))
+            if score >= min_score:
+                scored.append((key, score))
+        scored.sort(key=lambda item: (-item[1], item[0]))
+        return scored[:limit]
+    
+    def rows_by_sheet(self, key):
+        """Posiciones de fila por pestaña de una clave exacta"""
+        return self._rows.get(key, {})
+    
+    def search(self, search_term, sheet_names=None):
+        """Posiciones de fila por pestaña cuyas claves contienen el término"""
+        matches = {}
+        for key in self.matching_keys(search_term):
+            for sheet_name, rows in self._rows[key].items():
+                if sheet_names is None or sheet_name in sheet_names:
+                    matches.setdefault(sheet_name, []).append(rows)
+        return {
+            sheet_name: sorted(pos for rows in row_groups for pos in rows)
+            for sheet_name, row_groups in matches.items()
+        }
+
+# ==========================================
+# IDENTIDAD CANÓNICA DE COMEDORES
+# ==========================================
+
+def canonical_comedor_key(text):
+    """Clave canónica de un nombre: normalizado, sin puntuación ni el prefijo "comedor (comunitario)" """
+    key = re.sub(r"[^a-z0-9]+", " ", normalize_text(text)).strip()
+    return re.sub(r"^comedor(?:es)?(?: comunitarios?)? (?=\S)", "", key)
+
+def canonical_comedor_id(canonical_key):
+    return "COM-" + hashlib.sha1(canonical_key.encode("utf-8")).hexdigest()[:8]
+
+class ComedorIdentityTable:
+    """Asigna un ID canónico a cada comedor y guarda sus filas en cada pestaña.
+    
+    Se construye a partir del índice (claves normalizadas distintas, no filas), así que
+    una consulta entre fuentes es una búsqueda en diccionario en vez de seis recorridos.
+    """
+    
+    def __init__(self, index):
+        self._ids_by_key = {}  # clave canónica -> id
+        self._comedores = {}  # id -> {"id", "nombre", "clave", "filas": {pestaña: posiciones}}
+        
+        for key in index.keys():
+            canonical_key = canonical_comedor_key(key)
+            if not canonical_key:
+                continue
+            comedor_id = canonical_comedor_id(canonical_key)
+            self._ids_by_key[canonical_key] = comedor_id
+            comedor = self._comedores.setdefault(comedor_id, {
+                "id": comedor_id,
+                "nombre": None,
+                "clave": canonical_key,
+                "filas": {}
+            })
+            
+            rows_by_sheet = index.rows_by_sheet(key)
+            for sheet_name, rows in rows_by_sheet.items():
+                comedor["filas"].setdefault(sheet_name, []).extend(int(row) for row in rows)
+            # El nombre visible es el de la variante con más registros
+            total_rows = sum(len(rows) for rows in rows_by_sheet.values())
+            if comedor["nombre"] is None or total_rows > comedor["_registros_nombre"]:
+                comedor["nombre"] = index.display_name(key)
+                comedor["_registros_nombre"] = total_rows
+        
+        for comedor in self._comedores.values():
+            del comedor["_registros_nombre"]
+            for sheet_name in comedor["filas"]:
+                comedor["filas"][sheet_name].sort()
+    
+    def resolve(self, name):
+        """ID canónico del comedor con ese nombre (cualquier variante de escritura), o None"""
+        return self._ids_by_key.get(canonical_comedor_key(name))
+    
+    def get(self, comedor_id):
+        return self._comedores.get(comedor_id)
+    
+    def comedores(self):
+        return self._comedores.values()
+    
+    def __len__(self):
+        return len(self._comedores)
+
+class ComedorGazetteer:
+    """Reconoce en texto libre los nombres de comedores conocidos.
+    
+    Es un trie de palabras sobre las claves canónicas del catálogo: la consulta se
+    recorre una sola vez y en cada posición se toma la coincidencia más larga.
+    """
+    
+    def __init__(self, names):
+        self._trie = {}
+        for name in names:
+            tokens = canonical_comedor_key(name).split()
+            # Nombres de una sola palabra muy corta generarían falsos positivos
+            if not tokens or (len(tokens) == 1 and len(tokens[0]) < 3):
+                continue
+            node = self._trie
+            for token in tokens:
+                node = node.setdefault(token, {})
+            node[None] = name
+    
+    def find(self, text):
+        """Nombres de comedores mencionados en el texto, en orden de aparición"""
+        tokens = re.sub(r"[^a-z0-9]+", " ", normalize_text(text)).split()
+        matches = []
+        i = 0
+        while i < len(tokens):
+            node = self._trie
+            longest = None
+            j = i
+            while j < len(tokens) and tokens[j] in node:
+                node = node[tokens[j]]
+                j += 1
+                if None in node:
+                    longest = (node[None], j)
+            if longest:
+                matches.append(longest[0])
+                i = longest[1]
+            else:
+                i += 1
+        return matches
+
+class ComedorCatalog:
+    """Catálogo inmutable de comedores para una versión de datos.
+    
+    Guarda los nombres distintos ordenados, sus claves normalizadas y los agregados
+    que responden las estadísticas sin tocar los DataFrames: registros por comedor y
+    pestaña, totales y comedores distintos por pestaña, y totales por área. También
+    trae el mapa de campos canónicos → columnas de cada pestaña (ver build_schema_map).
+    """
+    
+    def __init__(self, identities, sheet_totals, data_version, sheet_config, schema_maps=None):
+        self.data_version = data_version
+        self.sheet_totals = sheet_totals
+        self.schema_maps = schema_maps or {}
+        comedores = sorted(identities.comedores(), key=lambda comedor: comedor["nombre"]) if identities else []
+        self.names = [comedor["nombre"] for comedor in comedores]
+        self.keys = [normalize_text(name) for name in self.names]
+        self._identities = identities
+        self.record_counts = {
+            comedor["id"]: {sheet_name: len(rows) for sheet_name, rows in comedor["filas"].items()}
+            for comedor in comedores
+        }
+        self.comedores_by_sheet = {}
+        for counts in self.record_counts.values():
+            for sheet_name in counts:
+                self.comedores_by_sheet[sheet_name] = self.comedores_by_sheet.get(sheet_name, 0) + 1
+        
+        # Totales por área: registros sumados y comedores distintos entre las pestañas del área
+        self.area_totals = {}
+        comedores_by_area = {}
+        for sheet_name, total in sheet_totals.items():
+            area = sheet_config[sheet_name]["area"]
+            area_total = self.area_totals.setdefault(area, {"total_registros": 0, "comedores": 0, "tablas": []})
+            area_total["total_registros"] += total
+            area_total["tablas"].append(sheet_name)
+            comedores_by_area.setdefault(area, set())
+        for comedor_id, counts in self.record_counts.items():
+            for sheet_name in counts:
+                comedores_by_area.setdefault(sheet_config[sheet_name]["area"], set()).add(comedor_id)
+        for area, comedor_ids in comedores_by_area.items():
+            if area in self.area_totals:
+                self.area_totals[area]["comedores"] = len(comedor_ids)
+        
+        self.gazetteer = ComedorGazetteer(self.names)
+        
+        # Índice ordenado de sufijos que empiezan en cada palabra: "semillas de paz", "de paz", "paz"
+        self._word_suffixes = sorted(
+            (key[match.start():], position)
+            for position, key in enumerate(self.keys)
+            for match in re.finditer(r"\S+", key)
+        )
+    
+    def comedor_counts(self, name):
+        """Registros por pestaña del comedor con ese nombre (cualquier variante), o None si no se reconoce"""
+        if self._identities is None or not name:
+            return None
+        return self.record_counts.get(self._identities.resolve(name))
+    
+    def autocomplete(self, text, limit=AUTOCOMPLETE_LIMIT):
+        """Hasta `limit` nombres cuyo nombre, o alguna de sus palabras, empieza con el texto"""
+        prefix = normalize_text(text)
+        if not prefix:
+            return self.names[:limit]
+        
+        full_matches = []
+        word_matches = []
+        start = bisect.bisect_left(self._word_suffixes, (prefix, -1))
+        for suffix, position in self._word_suffixes[start:]:
+            if not suffix.startswith(prefix):
                 break
-            if field != search_col and pd.notna(value) and str(value).strip() != "":
-                with cols[shown_fields % 2]:
-                    st.markdown(f"**{field}:** {value}")
-                shown_fields += 1
-        
-        # Expandir para ver todos los datos
-        with st.expander("Ver todos los datos", expanded=False):
-            for field, value in record.items():
-                if pd.notna(value) and str(value).strip() != "":
-                    st.text(f"{field}: {value}")
-        
-        st.markdown("</div>", unsafe_allow_html=True)
-
-def get_all_comedores():
-    """Obtiene una lista de todos los comedores únicos"""
-    all_comedores = set()
-    
-    for sheet_name, config in SHEET_CONFIG.items():
-        df = load_sheet_data(sheet_name)
-        if df is not None and not df.empty:
-            search_column = config["search_column"]
-            if search_column in df.columns:
-                comedores = df[search_column].dropna().astype(str).str.strip()
-                comedores = comedores[comedores != ""]
-                all_comedores.update(comedores.tolist())
-    
-    return sorted(list(all_comedores))
+            # Primero los que empiezan con el texto, luego los que lo tienen al inicio de otra palabra
+            if suffix == self.keys[position]:
+                full_matches.append(position)
+            else:
+                word_matches.append(position)
+        
+        positions = list(dict.fromkeys(sorted(full_matches) + sorted(word_matches)))
+        return [self.names[position] for position in positions[:limit]]
+    
+    def __len__(self):
+        return len(self.names)
+
+def search_all_sheets(search_term, sheet_names):
+    """Busca el término en las pestañas indicadas usando el índice compartido"""
+    # Asegura que cada pestaña esté cargada (y muestra sus avisos de carga)
+    loaded = [sheet_name for sheet_name in sheet_names if load_sheet_data(sheet_name) is not None]
+    results = get_sheet_store().search(search_term, loaded)
+    # Mismo orden que las pestañas solicitadas
+    return {sheet_name: results[sheet_name] for sheet_name in loaded if sheet_name in results}
+
+def fuzzy_search_comedores(search_term, limit=FUZZY_TOP_K):
+    """Top-k de comedores con nombre parecido al término (tolera errores de escritura)"""
+    store = get_sheet_store()
+    store.ensure_loaded()
+    return store.fuzzy_search(search_term, limit)
+
+def find_comedor_records(name, sheet_names=None):
+    """Registros de un comedor por pestaña según su identidad canónica ({} si no se reconoce)"""
+    store = get_sheet_store()
+    store.ensure_loaded()
+    comedor, records = store.comedor_records(name, sheet_names)
+    # Mismo orden que SHEET_CONFIG
+    return {sheet_name: records[sheet_name] for sheet_name in SHEET_CONFIG if sheet_name in records}
+
+def query_comedor_aggregates(kind, name=None):
+    """Agregaciones de la réplica SQL para el agente: "comuna" (conteos por comuna) o "fechas" (rango por pestaña).
+    
+    Con name se limita al comedor. Retorna None si la réplica SQL está desactivada.
+    """
+    store = get_sheet_store()
+    store.ensure_loaded()
+    if kind == "comuna":
+        return store.counts_by("comuna", name)
+    if kind == "fechas":
+        return store.date_ranges(name)
+    raise ValueError(f"Agregación desconocida: {kind}")
+
+def lookup_comedor_records(name, sheet_names=None):
+    """Filas de un comedor por pestaña: por identidad canónica si el nombre la tiene, si no por subcadena en el índice"""
+    # Sin llamadas de interfaz: el agente la ejecuta desde varios hilos a la vez
+    store = get_sheet_store()
+    sheet_names = list(sheet_names or SHEET_CONFIG.keys())
+    for sheet_name in sheet_names:
+        store.get(sheet_name)
+    records = store.lookup(name, sheet_names)
+    # Mismo orden que SHEET_CONFIG; el agente usa todas las columnas, así que se piden las filas completas
+    return {
+        sheet_name: store.materialize(sheet_name, records[sheet_name])
+        for sheet_name in SHEET_CONFIG if sheet_name in records
+    }
+
+def record_cards_html(records, sheet_name):
+    """Arma el HTML de las tarjetas de un bloque de registros (un bloque HTML por tarjeta).
+    
+    El texto de las celdas se calcula por columnas para todo el bloque de una vez;
+    por fila solo queda unir cadenas ya preparadas.
+    """
+    config = SHEET_CONFIG[sheet_name]
+    records = format_for_display(records)
+    search_col = config['search_column']
+    
+    # Proyección vectorizada: texto escapado de cada celda y si tiene contenido. Los saltos de
+    # línea se pasan a <br> para que una línea en blanco no corte el bloque HTML del markdown.
+    text = records.astype(object).where(records.notna(), "").astype(str).apply(lambda column: column.str.strip())
+    filled = text.ne("").to_numpy()
+    escaped = text.apply(lambda column: column.map(html.escape).str.replace("\n", "<br>")).to_numpy()
+    fields = [html.escape(str(field)) for field in records.columns]
+    comedor_position = records.columns.get_loc(search_col) if search_col in records.columns else None
+    
+    # Encabezado común a todas las tarjetas de la pestaña
+    header = (
+        f'<div style="display:flex;justify-content:space-between;align-items:baseline;">'
+        f'<h3 style="margin:0;">{html.escape(config["name"])}</h3>'
+        f'<span><b>Tabla:</b> <code>{html.escape(sheet_name)}</code></span></div>'
+        f'<p><b>🏢 Área:</b> {html.escape(config["area"])}'
+    )
+    if config['dashboard']:
+        dashboard = html.escape(config['dashboard'])
+        header += f'<br><b>📈 Dashboard:</b> <a href="{dashboard}" target="_blank">{dashboard}</a>'
+    header += '</p>'
+    
+    cards = []
+    for row_filled, row_text in zip(filled, escaped):
+        body = header
+        if comedor_position is not None and row_filled[comedor_position]:
+            body += f'<p><b>🍽️ Comedor:</b> {row_text[comedor_position]}</p>'
+        
+        # Primeros campos no vacíos en dos columnas, y todos los datos en un desplegable
+        present = [i for i in range(len(fields)) if row_filled[i]]
+        summary = [i for i in present if i != comedor_position][:CARD_SUMMARY_FIELDS]
+        body += '<div style="display:grid;grid-template-columns:1fr 1fr;gap:4px 16px;">'
+        body += "".join(f'<div><b>{fields[i]}:</b> {row_text[i]}</div>' for i in summary)
+        body += '</div><details><summary>Ver todos los datos</summary><div>'
+        body += "<br>".join(f'<b>{fields[i]}:</b> {row_text[i]}' for i in present)
+        body += '</div></details>'
+        
+        cards.append(
+            '<div style="border: 1px solid #ddd; border-radius: 10px; padding: 15px; margin: 10px 0; '
+            f'background-color: #f9f9f9; box-shadow: 0 2px 4px rgba(0,0,0,0.1);">{body}</div>'
+        )
+    return cards
+
+def display_record_cards(results, sheet_name, page_key):
+    """Muestra los registros como tarjetas, paginados: solo se dibuja la página visible"""
+    total_pages = max(1, -(-len(results) // RESULTS_PAGE_SIZE))
+    page = 1
+    if total_pages > 1:
+        page = st.number_input(
+            f"Página (de {total_pages}):",
+            min_value=1,
+            max_value=total_pages,
+            value=1,
+            step=1,
+            key=page_key
+        )
+    start = (page - 1) * RESULTS_PAGE_SIZE
+    # Las pestañas perezosas descargan aquí las filas completas, solo las de la página visible
+    page_results = get_sheet_store().materialize(sheet_name, results.iloc[start:start + RESULTS_PAGE_SIZE])
+    if total_pages > 1:
+        st.caption(f"Mostrando registros {start + 1}–{start + len(page_results)} de {len(results)}")
+    
+    # Toda la página en una sola llamada de dibujo
+    st.markdown("".join(record_cards_html(page_results, sheet_name)), unsafe_allow_html=True)
+
+def get_comedor_catalog():
+    """Catálogo de comedores de la versión de datos actual (memoizado en el almacén)"""
+    for sheet_name in SHEET_CONFIG:
+        # Asegura la carga de cada pestaña (y muestra sus avisos de carga)
+        load_sheet_data(sheet_name)
+    return get_sheet_store().catalog()
 
 # ==========================================
 # AGENTE DE INTELIGENCIA ARTIFICIAL
 # ==========================================
 
+class ResponseCache:
+    """Caché LRU acotada de consulta normalizada → respuesta del agente.
+    
+    Todas las entradas pertenecen a una misma versión de datos: cuando la versión
+    cambia, la caché se vacía sola antes de atender la siguiente consulta. Como el
+    historial del chat, guarda las respuestas en forma compacta (índices de filas, no
+    tablas) y las reconstruye en cada acierto.
+    """
+    
+    def __init__(self, max_size=RESPONSE_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._data_version = None
+        self._responses = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, query_key, data_version):
+        with self._lock:
+            self._check_version(data_version)
+            response = self._responses.get(query_key)
+            if response is None:
+                self.misses += 1
+                return None
+            self._responses.move_to_end(query_key)
+            self.hits += 1
+        return rehydrate_ai_response(response)
+    
+    def put(self, query_key, data_version, response):
+        compact = compact_ai_response(response)
+        with self._lock:
+            self._check_version(data_version)
+            self._responses[query_key] = compact
+            self._responses.move_to_end(query_key)
+            while len(self._responses) > self.max_size:
+                self._responses.popitem(last=False)
+    
+    def stats(self):
+        """Contadores para operadores"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "aciertos": self.hits,
+                "fallos": self.misses,
+                "tasa_aciertos": (self.hits / lookups * 100) if lookups else 0,
+                "entradas": len(self._responses),
+                "capacidad": self.max_size,
+                "invalidaciones": self.invalidations
+            }
+    
+    def _check_version(self, data_version):
+        if data_version != self._data_version:
+            if self._responses:
+                self.invalidations += 1
+            self._responses.clear()
+            self._data_version = data_version
+
+@st.cache_resource
+def get_response_cache():
+    """Caché de respuestas compartida por todas las sesiones del proceso"""
+    return ResponseCache()
+
+class ChatHistory:
+    """Historial acotado de una sesión del asistente, guardado en forma compacta.
+    
+    Cada interacción conserva la consulta, la intención y, por pestaña, los índices
+    de las filas con la versión de datos de la que salieron. Las tablas se
+    reconstruyen recién cuando se abre la respuesta. Las interacciones más antiguas
+    se descartan al superar la cantidad máxima o el tope de memoria.
+    """
+    
+    def __init__(self, max_entries=CHAT_HISTORY_SIZE, max_bytes=CHAT_HISTORY_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = deque(maxlen=max_entries)
+        self._next_id = 0
+    
+    def append(self, query, response, data_version=None):
+        entry = {
+            "id": self._next_id,
+            "query": query,
+            "intent": response["type"],
+            "data_version": data_version,
+            "response": compact_ai_response(response),
+            "timestamp": datetime.now().strftime("%H:%M:%S")
+        }
+        entry["bytes"] = len(json.dumps(entry, default=str))
+        self._next_id += 1
+        self._entries.append(entry)
+        
+        # Se conserva siempre la última interacción, aunque sola supere el tope
+        while len(self._entries) > 1 and self.memory_bytes() > self.max_bytes:
+            self._entries.popleft()
+        return entry
+    
+    def get(self, entry_id):
+        for entry in self._entries:
+            if entry["id"] == entry_id:
+                return entry
+        return None
+    
+    def latest(self):
+        return self._entries[-1] if self._entries else None
+    
+    def older(self):
+        """Interacciones anteriores a la última, de la más reciente a la más antigua"""
+        return list(self._entries)[-2::-1]
+    
+    def memory_bytes(self):
+        return sum(entry["bytes"] for entry in self._entries)
+    
+    def clear(self):
+        self._entries.clear()
+    
+    def __len__(self):
+        return len(self._entries)
+
 class ComedorAIAgent:
-    def __init__(self, sheet_config, load_sheet_data_func):
+    # Texto que sigue a palabras que suelen anteceder al nombre (compilados una sola vez)
+    NAME_CUE_PATTERNS = [
+        re.compile(r"comedor\s+([a-záéíóúñ\s]+?)(?:\s|$|,|\?|\.)"),
+        re.compile(r"del\s+([a-záéíóúñ\s]+?)(?:\s|$|,|\?|\.)"),
+        re.compile(r"llamado\s+([a-záéíóúñ\s]+?)(?:\s|$|,|\?|\.)"),
+        re.compile(r"nombre\s+([a-záéíóúñ\s]+?)(?:\s|$|,|\?|\.)")
+    ]
+    
+    def __init__(self, sheet_config, load_sheet_data_func, fuzzy_search_func=None, lookup_records_func=None,
+                 get_catalog_func=None, response_cache=None, aggregate_func=None):
         self.sheet_config = sheet_config
         self.load_sheet_data = load_sheet_data_func
+        self.fuzzy_search = fuzzy_search_func
+        self.lookup_records = lookup_records_func
+        self.get_catalog = get_catalog_func
+        self.response_cache = response_cache
+        self.aggregate = aggregate_func
         self.conversation_history = []
     
     def process_query(self, user_query):
-        """Procesa la consulta del usuario usando lógica de NLP básica"""
+        """Procesa la consulta del usuario y retorna la respuesta completa"""
+        for event, sheet_name, payload in self.stream_query(user_query):
+            if event == "response":
+                return payload
+    
+    def stream_query(self, user_query):
+        """Procesa la consulta entregando resultados parciales a medida que cada pestaña termina.
+        
+        Genera tuplas ("sheet", pestaña, filas) por cada pestaña con coincidencias y,
+        al final, ("response", None, respuesta). Las respuestas se reutilizan desde la
+        caché mientras la versión de datos (que viene del catálogo) no cambie.
+        """
+        use_cache = self.response_cache is not None and self.get_catalog is not None
+        if use_cache:
+            query_key = " ".join(user_query.lower().split())
+            data_version = self.get_catalog().data_version
+            response = self.response_cache.get(query_key, data_version)
+            if response is not None:
+                yield "response", None, response
+                return
+        
         query_lower = user_query.lower()
         
         # Detectar el nombre del comedor
@@ -305,38 +2326,93 @@ class ComedorAIAgent:
         # Detectar tipo de consulta
         query_type = self._detect_query_type(query_lower)
         
-        # Procesar según el tipo
+        if query_type == "general_search":
+            response = self._general_search(user_query)
+        elif query_type in ("comuna_counts", "date_range"):
+            # Se responden con consultas agregadas, sin traer las filas del comedor
+            response = self._aggregate_query(query_type, comedor_name)
+        elif query_type == "statistics" and (not comedor_name or self._comedor_counts(comedor_name) is not None):
+            # Los conteos salen del catálogo: no hace falta traer (ni descargar) las filas
+            response = self._generate_statistics(comedor_name, user_query, {})
+        else:
+            # Las filas del comedor se resuelven una sola vez (pestañas en paralelo) y se reutilizan
+            found = {}
+            for sheet_name, matches in self._iter_records(comedor_name):
+                found[sheet_name] = matches
+                yield "sheet", sheet_name, matches
+            records = {sheet_name: found[sheet_name] for sheet_name in self.sheet_config if sheet_name in found}
+            response = self._answer_query(comedor_name, query_type, user_query, records)
+        
+        if use_cache:
+            self.response_cache.put(query_key, data_version, response)
+        yield "response", None, response
+    
+    def _answer_query(self, comedor_name, query_type, user_query, records):
+        """Arma la respuesta según el tipo de consulta, con las filas ya resueltas"""
         if query_type == "search_comedor":
-            return self._search_comedor_info(comedor_name, user_query)
+            return self._search_comedor_info(comedor_name, user_query, records)
         elif query_type == "compare_data":
-            return self._compare_comedor_data(comedor_name, user_query)
+            return self._compare_comedor_data(comedor_name, user_query, records)
         elif query_type == "statistics":
-            return self._generate_statistics(comedor_name, user_query)
-        elif query_type == "cross_analysis":
-            return self._cross_analysis(comedor_name, user_query)
+            return self._generate_statistics(comedor_name, user_query, records)
         else:
-            return self._general_search(user_query)
+            return self._cross_analysis(comedor_name, user_query, records)
     
     def _extract_comedor_name(self, query):
         """Extrae el nombre del comedor de la consulta"""
-        # Patrones comunes para identificar nombres de comedores
-        patterns = [
-            r"comedor\s+([a-záéíóúñ\s]+?)(?:\s|$|,|\?|\.)",
-            r"del\s+([a-záéíóúñ\s]+?)(?:\s|$|,|\?|\.)",
-            r"llamado\s+([a-záéíóúñ\s]+?)(?:\s|$|,|\?|\.)",
-            r"nombre\s+([a-záéíóúñ\s]+?)(?:\s|$|,|\?|\.)",
-            r"([a-záéíóúñ\s]{3,})(?:\s|$|,|\?|\.)"  # Palabras de 3+ caracteres
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, query)
+        # Primero los comedores conocidos del catálogo (una sola pasada sobre la consulta)
+        if self.get_catalog:
+            matches = self.get_catalog().gazetteer.find(query)
+            if matches:
+                return matches[0]
+        
+        # Si no, el texto que sigue a "comedor", "del", "llamado" o "nombre"
+        for pattern in self.NAME_CUE_PATTERNS:
+            match = pattern.search(query)
             if match:
                 return match.group(1).strip()
         return None
     
+    def _resolve_records(self, comedor_name):
+        """Filas del comedor por pestaña, obtenidas del índice compartido (sin recorrer las tablas)"""
+        return dict(self._iter_records(comedor_name))
+    
+    def _iter_records(self, comedor_name):
+        """Genera (pestaña, filas) en el orden en que termina cada pestaña; solo las que tienen filas"""
+        if not comedor_name:
+            return
+        
+        if not self.lookup_records:
+            # Sin índice disponible: comparación literal sobre los nombres normalizados
+            for sheet_name, config in self.sheet_config.items():
+                matches = search_in_dataframe(self.load_sheet_data(sheet_name), config["search_column"], comedor_name)
+                if not matches.empty:
+                    yield sheet_name, matches
+            return
+        
+        # Una tarea por pestaña: la primera que termina se entrega sin esperar a las demás.
+        # Los hilos heredan el contexto de Streamlit de la sesión que hizo la consulta.
+        ctx = get_script_run_ctx()
+        with ThreadPoolExecutor(
+            max_workers=len(self.sheet_config),
+            initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)
+        ) as executor:
+            futures = {
+                executor.submit(self.lookup_records, comedor_name, [sheet_name]): sheet_name
+                for sheet_name in self.sheet_config
+            }
+            for future in as_completed(futures):
+                matches = future.result().get(futures[future])
+                if matches is not None and len(matches) > 0:
+                    yield futures[future], matches
+    
     def _detect_query_type(self, query):
         """Detecta el tipo de consulta basado en palabras clave"""
-        if any(word in query for word in ["busca", "información", "datos", "todo", "completo"]):
+        if "comuna" in query and any(word in query for word in ["cuántos", "cuantos", "conteo", "por comuna", "total", "registros"]):
+            return "comuna_counts"
+        elif any(word in query for word in ["fecha", "cuándo", "cuando", "rango", "primera visita", "última visita"]):
+            return "date_range"
+        elif any(word in query for word in ["busca", "información", "datos", "todo", "completo"]):
             return "search_comedor"
         elif any(word in query for word in ["compara", "diferencias", "vs", "versus", "cruce"]):
             return "compare_data"
@@ -347,7 +2423,7 @@ class ComedorAIAgent:
         else:
             return "general_search"
     
-    def _search_comedor_info(self, comedor_name, original_query):
+    def _search_comedor_info(self, comedor_name, original_query, records=None):
         """Busca información completa de un comedor específico"""
         if not comedor_name:
             return {
@@ -355,31 +2431,31 @@ class ComedorAIAgent:
                 "message": "No pude identificar el nombre del comedor. ¿Podrías especificarlo más claramente?"
             }
         
+        if records is None:
+            records = self._resolve_records(comedor_name)
+        
         results = {}
         total_records = 0
         
-        # Buscar en todas las tablas
-        for sheet_name, config in self.sheet_config.items():
-            df = self.load_sheet_data(sheet_name)
-            if df is not None and not df.empty:
-                search_column = config["search_column"]
-                if search_column in df.columns:
-                    # Búsqueda flexible
-                    mask = df[search_column].astype(str).str.contains(comedor_name, case=False, na=False)
-                    matches = df[mask]
-                    
-                    if not matches.empty:
-                        results[sheet_name] = {
-                            "config": config,
-                            "data": matches,
-                            "count": len(matches)
-                        }
-                        total_records += len(matches)
+        for sheet_name, matches in records.items():
+            results[sheet_name] = {
+                "config": self.sheet_config[sheet_name],
+                "data": matches,
+                "count": len(matches)
+            }
+            total_records += len(matches)
         
         if total_records == 0:
+            suggestions = self.fuzzy_search(comedor_name) if self.fuzzy_search else []
+            if suggestions:
+                names = ", ".join(f"'{suggestion['nombre']}'" for suggestion in suggestions)
+                message = f"No encontré información para el comedor '{comedor_name}'. ¿Quisiste decir {names}?"
+            else:
+                message = f"No encontré información para el comedor '{comedor_name}'. ¿Verificaste el nombre?"
             return {
                 "type": "no_results",
-                "message": f"No encontré información para el comedor '{comedor_name}'. ¿Verificaste el nombre?"
+                "message": message,
+                "suggestions": suggestions
             }
         
         return {
@@ -390,9 +2466,9 @@ class ComedorAIAgent:
             "message": f"Encontré {total_records} registros para '{comedor_name}' en {len(results)} tabla(s)"
         }
     
-    def _compare_comedor_data(self, comedor_name, query):
+    def _compare_comedor_data(self, comedor_name, query, records=None):
         """Compara datos entre diferentes tablas para un comedor"""
-        info_result = self._search_comedor_info(comedor_name, query)
+        info_result = self._search_comedor_info(comedor_name, query, records)
         
         if info_result["type"] != "comedor_info":
             return info_result
@@ -402,7 +2478,7 @@ class ComedorAIAgent:
         
         for sheet_name, sheet_data in results.items():
             config = sheet_data["config"]
-            df = sheet_data["data"]
+            df = drop_internal_columns(sheet_data["data"])
             
             # Extraer información clave para comparación
             comparison[sheet_name] = {
@@ -420,40 +2496,67 @@ class ComedorAIAgent:
             "message": f"Análisis comparativo de '{comedor_name}' entre {len(comparison)} fuentes de datos"
         }
     
-    def _generate_statistics(self, comedor_name, query):
-        """Genera estadísticas generales o específicas"""
+    def _generate_statistics(self, comedor_name, query, records=None):
+        """Genera estadísticas generales o específicas.
+        
+        Los registros de un comedor reconocido salen de catalog.record_counts; solo los
+        nombres que no se resuelven a un comedor canónico necesitan sus filas.
+        """
         stats = {}
+        catalog = self.get_catalog() if self.get_catalog else None
+        counts = self._comedor_counts(comedor_name)
+        if comedor_name and counts is None:
+            if records is None:
+                records = self._resolve_records(comedor_name)
+            counts = {sheet_name: len(rows) for sheet_name, rows in records.items()}
         
         for sheet_name, config in self.sheet_config.items():
-            df = self.load_sheet_data(sheet_name)
-            if df is not None and not df.empty:
-                search_column = config["search_column"]
-                
+            total_records, unique_comedores = self._sheet_totals(sheet_name, catalog)
+            if total_records:
                 if comedor_name:
                     # Estadísticas específicas del comedor
-                    mask = df[search_column].astype(str).str.contains(comedor_name, case=False, na=False)
-                    filtered_df = df[mask]
+                    comedor_records = counts.get(sheet_name, 0)
                     stats[sheet_name] = {
-                        "registros_comedor": len(filtered_df),
-                        "total_registros": len(df),
-                        "porcentaje": (len(filtered_df) / len(df) * 100) if len(df) > 0 else 0
+                        "registros_comedor": comedor_records,
+                        "total_registros": total_records,
+                        "porcentaje": comedor_records / total_records * 100
                     }
                 else:
                     # Estadísticas generales
                     stats[sheet_name] = {
-                        "total_registros": len(df),
-                        "comedores_unicos": df[search_column].nunique() if search_column in df.columns else 0,
+                        "total_registros": total_records,
+                        "comedores_unicos": unique_comedores,
                         "area": config["area"]
                     }
         
-        return {
+        response = {
             "type": "statistics",
             "comedor_name": comedor_name,
             "stats": stats,
             "message": f"Estadísticas {'para ' + comedor_name if comedor_name else 'generales'}"
         }
+        if catalog is not None and not comedor_name:
+            response["por_area"] = catalog.area_totals
+        return response
     
-    def _cross_analysis(self, comedor_name, query):
+    def _comedor_counts(self, comedor_name):
+        """Registros por pestaña de un comedor reconocido, desde el catálogo (None si no se puede)"""
+        if not comedor_name or not self.get_catalog:
+            return None
+        return self.get_catalog().comedor_counts(comedor_name)
+    
+    def _sheet_totals(self, sheet_name, catalog):
+        """(registros, comedores distintos) de la pestaña: del catálogo precalculado si está disponible"""
+        if catalog is not None:
+            return catalog.sheet_totals.get(sheet_name, 0), catalog.comedores_by_sheet.get(sheet_name, 0)
+        
+        df = self.load_sheet_data(sheet_name)
+        if df is None or df.empty:
+            return 0, 0
+        search_column = self.sheet_config[sheet_name]["search_column"]
+        return len(df), (df[search_column].nunique() if search_column in df.columns else 0)
+    
+    def _cross_analysis(self, comedor_name, query, records=None):
         """Realiza análisis cruzado entre diferentes fuentes"""
         if not comedor_name:
             return {
@@ -462,29 +2565,27 @@ class ComedorAIAgent:
             }
         
         # Buscar datos del comedor en todas las fuentes
-        info_result = self._search_comedor_info(comedor_name, query)
+        info_result = self._search_comedor_info(comedor_name, query, records)
         
         if info_result["type"] != "comedor_info":
             return info_result
         
         cross_data = {}
         results = info_result["results"]
-        
-        # Extraer campos comunes para análisis
-        common_fields = ["direccion", "barrio", "comuna", "fecha", "telefono", "gestora"]
+        schema_maps = self.get_catalog().schema_maps if self.get_catalog else {}
         
         for sheet_name, sheet_data in results.items():
-            df = sheet_data["data"]
+            df = format_for_display(sheet_data["data"])
             config = sheet_data["config"]
             
-            # Buscar campos similares
+            # Proyección directa de los campos comunes según el mapa calculado al cargar la pestaña
+            schema = schema_maps.get(sheet_name)
+            if schema is None:
+                schema = build_schema_map(df.columns, config)
             matched_fields = {}
-            for field in common_fields:
-                for col in df.columns:
-                    if field.lower() in col.lower():
-                        if len(df) > 0:
-                            matched_fields[field] = df[col].iloc[0]
-                        break
+            if len(df) > 0:
+                first_record = df.iloc[0]
+                matched_fields = {field: first_record[column] for field, column in schema.items()}
             
             cross_data[sheet_name] = {
                 "area": config["area"],
@@ -499,18 +2600,112 @@ class ComedorAIAgent:
             "message": f"Análisis cruzado completado para '{comedor_name}'"
         }
     
+    def _aggregate_query(self, query_type, comedor_name):
+        """Conteos por comuna o rango de fechas, resueltos con la réplica SQL (de todo o de un comedor)"""
+        target = f"'{comedor_name}'" if comedor_name else "todos los comedores"
+        kind = "comuna" if query_type == "comuna_counts" else "fechas"
+        rows = self.aggregate(kind, comedor_name) if self.aggregate else None
+        if rows is None:
+            return {
+                "type": "error",
+                "message": "Las consultas por comuna y por fechas necesitan la réplica SQL, que está desactivada"
+            }
+        if not rows:
+            return {
+                "type": "no_results",
+                "message": f"No encontré {'comunas' if kind == 'comuna' else 'fechas'} registradas para {target}"
+            }
+        
+        if kind == "comuna":
+            return {
+                "type": "comuna_counts",
+                "comedor_name": comedor_name,
+                "rows": [
+                    {"Comuna": comuna, "Registros": registros, "Comedores": comedores, "Tablas": tablas}
+                    for comuna, registros, comedores, tablas in rows
+                ],
+                "message": f"Registros por comuna para {target} ({len(rows)} comuna(s))"
+            }
+        return {
+            "type": "date_range",
+            "comedor_name": comedor_name,
+            "rows": [
+                {"Tabla": sheet_name, "Área": self.sheet_config[sheet_name]["area"], "Desde": first, "Hasta": last, "Registros con fecha": count}
+                for sheet_name, first, last, count in rows
+            ],
+            "message": f"Rango de fechas para {target}: del {min(row[1] for row in rows)[:10]} al {max(row[2] for row in rows)[:10]}"
+        }
+    
     def _general_search(self, query):
         """Búsqueda general basada en la consulta"""
         return {
             "type": "general",
-            "message": "Puedo ayudarte con consultas como:\n- 'Busca información del comedor Semillas'\n- 'Compara datos del comedor La Esperanza'\n- 'Estadísticas del comedor Nuevo Horizonte'\n- '¿Cuántos registros hay en total?'"
+            "message": "Puedo ayudarte con consultas como:\n- 'Busca información del comedor Semillas'\n- 'Compara datos del comedor La Esperanza'\n- 'Estadísticas del comedor Nuevo Horizonte'\n- '¿Cuántos registros hay en total?'\n- '¿Cuántos registros hay por comuna?'\n- 'Fechas de visita del comedor San José'"
+        }
+def compact_ai_response(response):
+    """Copia de la respuesta apta para el historial: filas como índices más la versión de la pestaña"""
+    compact = dict(response)
+    if "results" in response:
+        store = get_sheet_store()
+        compact["results"] = {}
+        for sheet_name, sheet_data in response["results"].items():
+            entry = store.get_entry(sheet_name)
+            compact["results"][sheet_name] = {
+                "filas": sheet_data["data"].index.tolist(),
+                "version": entry["version"] if entry is not None else None,
+                "count": sheet_data["count"]
+            }
+    if "comparison" in response:
+        # El primer registro no se muestra; se descarta para no guardar filas completas
+        compact["comparison"] = {
+            sheet_name: {key: value for key, value in data.items() if key != "primer_registro"}
+            for sheet_name, data in response["comparison"].items()
+        }
+    return compact
+
+def rehydrate_ai_response(compact):
+    """Reconstruye las tablas de una respuesta compacta a partir de los datos cargados"""
+    if "results" not in compact:
+        return compact
+    
+    store = get_sheet_store()
+    response = dict(compact)
+    response["results"] = {}
+    for sheet_name, refs in compact["results"].items():
+        df = store.get(sheet_name)
+        entry = store.get_entry(sheet_name)
+        if df is None:
+            data = pd.DataFrame()
+        elif entry["version"] == refs["version"]:
+            data = store.materialize(sheet_name, df.loc[refs["filas"]])
+        else:
+            # La pestaña cambió desde la consulta: las posiciones ya no son confiables, se vuelve a buscar
+            data = lookup_comedor_records(compact["comedor_name"], [sheet_name]).get(sheet_name, df.iloc[0:0])
+        response["results"][sheet_name] = {
+            "config": SHEET_CONFIG[sheet_name],
+            "data": data,
+            "count": len(data)
         }
+    return response
+
+def open_chat_entry(entry_id):
+    """Callback del historial: marca qué respuesta anterior se muestra"""
+    st.session_state.ai_opened_entry = entry_id
+
 def display_ai_response(response):
     """Muestra la respuesta del agente IA"""
     
     if response["type"] == "error" or response["type"] == "no_results":
         st.error(response["message"])
         
+        if response.get("suggestions"):
+            st.markdown("**🔤 Comedores con nombre parecido:**")
+            st.dataframe(pd.DataFrame([{
+                "Comedor": suggestion["nombre"],
+                "Similitud (%)": round(suggestion["puntaje"] * 100),
+                "Registros": suggestion["registros"]
+            } for suggestion in response["suggestions"]]))
+        
     elif response["type"] == "general":
         st.info(response["message"])
         
@@ -534,7 +2729,7 @@ def display_ai_response(response):
                     
                     # Mostrar datos en tabla expandible
                     with st.expander(f"Ver {len(df)} registro(s)", expanded=False):
-                        st.dataframe(df)
+                        st.dataframe(format_for_display(df))
         else:
             # Solo una tabla con resultados
             sheet_name = list(response["results"].keys())[0]
@@ -547,7 +2742,7 @@ def display_ai_response(response):
             if config['dashboard']:
                 st.markdown(f"**📈 Dashboard:** [{config['dashboard']}]({config['dashboard']})")
             
-            st.dataframe(df)
+            st.dataframe(format_for_display(df))
     
     elif response["type"] == "comparison":
         st.success(response["message"])
@@ -610,11 +2805,31 @@ def display_ai_response(response):
             df_stats = pd.DataFrame(data)
             st.dataframe(df_stats)
             
-            # Gráfico de registros por área
-            fig = px.pie(df_stats, values="Total Registros", names="Área", 
+            # Gráfico de registros por área (desde los totales por área precalculados, si vienen)
+            if response.get("por_area"):
+                df_areas = pd.DataFrame([
+                    {"Área": area, "Total Registros": totals["total_registros"]}
+                    for area, totals in response["por_area"].items()
+                ])
+            else:
+                df_areas = df_stats
+            fig = px.pie(df_areas, values="Total Registros", names="Área", 
                         title="Distribución de registros por área")
             st.plotly_chart(fig)
     
+    elif response["type"] == "comuna_counts":
+        st.success(response["message"])
+        
+        df_counts = pd.DataFrame(response["rows"])
+        st.dataframe(df_counts)
+        fig = px.bar(df_counts, x="Comuna", y="Registros", hover_data=["Comedores", "Tablas"],
+                    title="Registros por comuna")
+        st.plotly_chart(fig)
+    
+    elif response["type"] == "date_range":
+        st.success(response["message"])
+        st.dataframe(pd.DataFrame(response["rows"]))
+    
     elif response["type"] == "cross_analysis":
         st.success(response["message"])
         
@@ -629,6 +2844,15 @@ def display_ai_response(response):
                 else:
                     st.write("No se encontraron campos comunes")
 
+def show_response_cache_stats():
+    """Contadores de la caché de respuestas del asistente (para operadores)"""
+    cache_stats = get_response_cache().stats()
+    st.write(f"✅ **Aciertos:** {cache_stats['aciertos']}")
+    st.write(f"❌ **Fallos:** {cache_stats['fallos']}")
+    st.write(f"📈 **Tasa de aciertos:** {cache_stats['tasa_aciertos']:.1f}%")
+    st.write(f"🗂️ **Entradas:** {cache_stats['entradas']} / {cache_stats['capacidad']}")
+    st.write(f"♻️ **Invalidaciones por datos nuevos:** {cache_stats['invalidaciones']}")
+
 def show_ai_agent_page():
     """Muestra la página del agente IA"""
     
@@ -648,11 +2872,14 @@ def show_ai_agent_page():
     
     # Inicializar el agente IA
     if 'ai_agent' not in st.session_state:
-        st.session_state.ai_agent = ComedorAIAgent(SHEET_CONFIG, load_sheet_data)
+        st.session_state.ai_agent = ComedorAIAgent(
+            SHEET_CONFIG, load_sheet_data, fuzzy_search_comedores, lookup_comedor_records, get_comedor_catalog,
+            get_response_cache(), query_comedor_aggregates
+        )
     
     # Historial de conversación
     if 'chat_history' not in st.session_state:
-        st.session_state.chat_history = []
+        st.session_state.chat_history = ChatHistory()
     
     # Campo de entrada de consulta
     user_query = st.text_input(
@@ -668,37 +2895,63 @@ def show_ai_agent_page():
     
     with col2:
         if st.button("🗑️ Limpiar historial"):
-            st.session_state.chat_history = []
+            st.session_state.chat_history.clear()
+            st.session_state.ai_opened_entry = None
             st.rerun()
     
     # Procesar consulta
     if submit_query and user_query:
+        # Resultados parciales: cada pestaña aparece apenas termina; al final se reemplazan por la respuesta completa
+        partial_results = st.empty()
         with st.spinner("🧠 Procesando tu consulta..."):
-            response = st.session_state.ai_agent.process_query(user_query)
-            
-            # Agregar al historial
-            st.session_state.chat_history.append({
-                "query": user_query,
-                "response": response,
-                "timestamp": datetime.now().strftime("%H:%M:%S")
-            })
-    
-    # Mostrar respuesta actual
-    if st.session_state.chat_history:
-        latest_interaction = st.session_state.chat_history[-1]
+            with partial_results.container():
+                for event, sheet_name, payload in st.session_state.ai_agent.stream_query(user_query):
+                    if event == "sheet":
+                        config = SHEET_CONFIG[sheet_name]
+                        st.markdown(f"✅ **{config['name']}:** {len(payload)} registro(s) encontrado(s)")
+                        st.dataframe(format_for_display(payload))
+                    else:
+                        response = payload
+        partial_results.empty()
         
+        # Agregar al historial (en forma compacta)
+        data_version = get_comedor_catalog().data_version
+        st.session_state.chat_history.append(user_query, response, data_version)
+        st.session_state.ai_opened_entry = None
+    
+    # Mostrar respuesta actual (recién calculada o reconstruida desde el historial)
+    chat_history = st.session_state.chat_history
+    if len(chat_history):
         st.markdown("### 💭 Respuesta:")
-        display_ai_response(latest_interaction["response"])
+        if submit_query and user_query:
+            display_ai_response(response)
+        else:
+            display_ai_response(rehydrate_ai_response(chat_history.latest()["response"]))
     
     # Mostrar historial
-    if len(st.session_state.chat_history) > 1:
+    if len(chat_history) > 1:
         with st.expander("📚 Historial de conversación", expanded=False):
-            for i, interaction in enumerate(reversed(st.session_state.chat_history[:-1])):
+            older = chat_history.older()
+            for i, interaction in enumerate(older):
                 st.markdown(f"**[{interaction['timestamp']}] 👤:** {interaction['query']}")
                 st.markdown(f"**🤖:** {interaction['response']['message']}")
-                if i < len(st.session_state.chat_history) - 2:
+                st.button("📂 Ver respuesta", key=f"open_chat_{interaction['id']}",
+                          on_click=open_chat_entry, args=(interaction["id"],))
+                if i < len(older) - 1:
                     st.markdown("---")
     
+    # Respuesta anterior abierta desde el historial: recién aquí se reconstruyen sus tablas
+    opened = chat_history.get(st.session_state.get("ai_opened_entry"))
+    if opened is not None and opened is not chat_history.latest():
+        st.markdown(f"### 📂 Respuesta anterior [{opened['timestamp']}]: {opened['query']}")
+        display_ai_response(rehydrate_ai_response(opened["response"]))
+    
+    # Estado de la caché de respuestas (para operadores)
+    with st.sidebar.expander("⚙️ Caché de respuestas", expanded=False):
+        show_response_cache_stats()
+        st.write(f"💬 **Historial de esta sesión:** {len(chat_history)} interacción(es) · "
+                 f"{chat_history.memory_bytes() / 1024:.1f} / {chat_history.max_bytes / 1024:.0f} KB")
+    
     # Ejemplos de consultas
     st.markdown("### 💡 Ejemplos de consultas:")
     
@@ -707,7 +2960,9 @@ def show_ai_agent_page():
         "Compara datos del comedor La Esperanza",
         "Estadísticas del comedor Nuevo Horizonte",
         "¿Cuántos comedores hay en total?",
-        "Análisis cruzado del comedor San José"
+        "Análisis cruzado del comedor San José",
+        "¿Cuántos registros hay por comuna?",
+        "Fechas de visita del comedor San José"
     ]
     
     cols = st.columns(2)
@@ -717,6 +2972,10 @@ def show_ai_agent_page():
                 st.session_state.ai_query_input = example
                 st.rerun()
 
+def set_typed_search_term(term):
+    """Callback: reemplaza el texto de búsqueda (se ejecuta antes del siguiente rerun)"""
+    st.session_state.typed_search_term = term
+
 def show_search_page():
     """Muestra la página de búsqueda tradicional"""
     st.title("🍽️ Buscador de Comedores Comunitarios")
@@ -726,16 +2985,29 @@ def show_search_page():
     with st.sidebar:
         st.header("🔍 Seleccionar Comedor")
         
-        # Solo opción de seleccionar de lista
         with st.spinner("Cargando lista de comedores..."):
-            comedores_list = get_all_comedores()
+            catalog = get_comedor_catalog()
         
-        search_term = st.selectbox(
+        typed_term = st.text_input(
+            "Escriba el nombre del comedor:",
+            key="typed_search_term",
+            help="La búsqueda ignora mayúsculas y acentos"
+        )
+        
+        # Autocompletado en el servidor: al navegador solo viajan las primeras coincidencias
+        selected_comedor = st.selectbox(
             "Seleccione un comedor:",
-            [""] + comedores_list,
+            [""] + catalog.autocomplete(typed_term),
             index=0,
-            help="Seleccione de la lista completa de comedores"
+            help=f"Hasta {AUTOCOMPLETE_LIMIT} de los {len(catalog)} comedores que coinciden con lo escrito"
         )
+        fuzzy_mode = st.checkbox(
+            "🔤 Tolerar errores de escritura",
+            value=True,
+            key="fuzzy_mode",
+            help="Si no hay coincidencias exactas, sugiere los comedores con nombre más parecido"
+        )
+        search_term = selected_comedor or typed_term.strip()
         
         # Filtro por tablas
         st.subheader("📊 Filtrar por tablas")
@@ -745,11 +3017,46 @@ def show_search_page():
             if st.checkbox(config["name"], value=True, key=f"filter_{sheet_name}"):
                 selected_sheets.append(sheet_name)
         
+        refresh_target = st.selectbox(
+            "Pestaña a actualizar:",
+            ["Todas"] + list(SHEET_CONFIG.keys()),
+            format_func=lambda name: name if name == "Todas" else SHEET_CONFIG[name]["name"],
+            key="refresh_target"
+        )
         if st.button("🔄 Actualizar datos", help="Forzar actualización desde Google Sheets"):
-            st.cache_data.clear()
-            st.cache_resource.clear()
-            st.success("✅ Cache limpiado. Los datos se actualizarán en la próxima búsqueda.")
+            # Solo se reemplazan los datos de las pestañas; credenciales y cliente se conservan.
+            # Es una recarga completa: recoge también ediciones en filas antiguas de las encuestas
+            with st.spinner("Sincronizando datos desde Google Sheets..."):
+                if refresh_target == "Todas":
+                    get_sheet_store().refresh(full=True)
+                else:
+                    get_sheet_store().refresh([refresh_target], full=True)
+            st.success("✅ Datos actualizados desde Google Sheets.")
             st.rerun()
+        
+        # Picos de cuota o caídas de la API: se sigue mostrando la última versión buena
+        degraded = get_sheet_store().degraded_sheets()
+        if degraded:
+            st.warning(
+                f"⚠️ No se pudo actualizar {', '.join(degraded)}. Se muestran los últimos datos disponibles; "
+                "se reintentará automáticamente."
+            )
+        
+        # Memoria ocupada por los datos cargados (para operadores)
+        with st.expander("💾 Memoria de datos", expanded=False):
+            memory_report = get_sheet_store().memory_report()
+            for sheet_name, memory in memory_report.items():
+                st.write(
+                    f"**{sheet_name}:** {memory['antes'] / 1024 ** 2:.2f} MB → {memory['despues'] / 1024 ** 2:.2f} MB"
+                )
+            if memory_report:
+                before = sum(memory["antes"] for memory in memory_report.values())
+                after = sum(memory["despues"] for memory in memory_report.values())
+                st.write(f"**Total:** {before / 1024 ** 2:.2f} MB → {after / 1024 ** 2:.2f} MB")
+        
+        # Caché de respuestas del asistente, compartida por todas las sesiones (para operadores)
+        with st.expander("⚙️ Caché de respuestas", expanded=False):
+            show_response_cache_stats()
     
     # Área principal
     if search_term and search_term.strip():
@@ -760,15 +3067,12 @@ def show_search_page():
         
         # Buscar en cada tabla seleccionada
         with st.spinner("Buscando en las bases de datos..."):
-            for sheet_name in selected_sheets:
-                config = SHEET_CONFIG[sheet_name]
-                df = load_sheet_data(sheet_name)
-                
-                if df is not None:
-                    results = search_in_dataframe(df, config["search_column"], search_term)
-                    if not results.empty:
-                        results_by_sheet[sheet_name] = results
-                        total_results += len(results)
+            if selected_comedor:
+                # Comedor elegido de la lista: sus filas salen directo de la tabla de identidad
+                results_by_sheet = find_comedor_records(search_term, selected_sheets)
+            else:
+                results_by_sheet = search_all_sheets(search_term, selected_sheets)
+            total_results = sum(len(results) for results in results_by_sheet.values())
         
         # Mostrar resumen de resultados
         if total_results > 0:
@@ -783,8 +3087,7 @@ def show_search_page():
                         st.markdown(f"**{len(results)} registro(s) encontrado(s)**")
                         config = SHEET_CONFIG[sheet_name]
                         
-                        for idx, record in results.iterrows():
-                            display_record_card(record, sheet_name)
+                        display_record_cards(results, sheet_name, f"page_{sheet_name}_{search_term}")
             else:
                 # Solo una tabla con resultados
                 sheet_name = list(results_by_sheet.keys())[0]
@@ -793,12 +3096,23 @@ def show_search_page():
                 
                 st.markdown(f"**{len(results)} registro(s) encontrado(s) en {config['name']}**")
                 
-                for idx, record in results.iterrows():
-                    display_record_card(record, sheet_name)
+                display_record_cards(results, sheet_name, f"page_{sheet_name}_{search_term}")
         
         else:
             st.warning("❌ No se encontraron registros que coincidan con la búsqueda.")
-            st.info("💡 Sugerencias:\n- Verifique la ortografía\n- Intente con parte del nombre\n- Seleccione más tablas para buscar")
+            
+            suggestions = fuzzy_search_comedores(search_term) if fuzzy_mode else []
+            if suggestions:
+                st.markdown("### 🔤 ¿Quiso decir...?")
+                for i, suggestion in enumerate(suggestions):
+                    st.button(
+                        f"{suggestion['nombre']} · {round(suggestion['puntaje'] * 100)}% · {suggestion['registros']} registro(s)",
+                        key=f"fuzzy_suggestion_{i}",
+                        on_click=set_typed_search_term,
+                        args=(suggestion["nombre"],)
+                    )
+            else:
+                st.info("💡 Sugerencias:\n- Verifique la ortografía\n- Intente con parte del nombre\n- Seleccione más tablas para buscar")
     
     else:
         # Página de inicio
@@ -811,11 +3125,12 @@ def show_search_page():
         ### 📋 Bases de datos disponibles:
         """)
         
+        catalog = get_comedor_catalog()
         for sheet_name, config in SHEET_CONFIG.items():
             with st.expander(f"{config['name']}", expanded=False):
-                df = load_sheet_data(sheet_name)
-                if df is not None:
-                    st.write(f"📊 **Registros:** {len(df)}")
+                if sheet_name in catalog.sheet_totals:
+                    st.write(f"📊 **Registros:** {catalog.sheet_totals[sheet_name]}")
+                    st.write(f"🍽️ **Comedores:** {catalog.comedores_by_sheet.get(sheet_name, 0)}")
                     st.write(f"🏢 **Área:** {config['area']}")
                     st.write(f"🎯 **Propósito:** {config['proposito']}")
                     if config['dashboard']:
@@ -831,7 +3146,7 @@ def show_search_page():
         
         ### 💡 Consejos:
         - La búsqueda es **flexible**: puede escribir parte del nombre
-        - Use el **selector de lista** para ver todos los comedores disponibles
+        - Use el **selector de lista** para elegir entre los comedores que coinciden con lo escrito
         - **Filtre por tablas** para búsquedas más específicas
         - **Expanda las tarjetas** para ver información detallada
         """)